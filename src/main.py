@@ -2,11 +2,29 @@
 # IMPORT
 #==================================================================================
 import sys
-import pygame
+import os
+import argparse
+import collections
+import struct
+import zlib
+import gzip
+import zipfile
+import json
+import sqlite3
+import concurrent.futures
+import threading
+import queue
+import atexit
+import mmap
+import wave
 import numpy as np
 import time
 
-keys = [0] * 256
+# Imported by pygameVideo only, headless runs never load pygame
+pygame = None
+
+# Controller buttons: A, B, Select, Start, Up, Down, Left, Right
+keys = [0] * 8
 
 #==================================================================================
 # PARSER
@@ -14,46 +32,355 @@ keys = [0] * 256
 
 class romLoader:
     rom = 0
+    regions = ['NTSC', 'PAL', 'multi', 'Dendy']
 
-    def __init__(self, romPath):
+    # member picks a ROM inside a .zip, by default the first .nes file in it
+    def __init__(self, romPath, database=None, member=None, archives=None):
+        self.path = romPath
+        self.member = member
+        self.archives = archives
         self.rom = self.openFile(romPath)
+        self.database = database
 
+    # The whole ROM as one bytes buffer, .zip and .gz are recognized by their magic.
+    # The file is closed before returning.
     def openFile(self, romPath):
-        rom = open(romPath, 'rb')
+        with open(romPath, 'rb') as f:
+            magic = f.read(4)
+            if magic == b'PK\x03\x04':
+                return self.readZipMember(f)
+            f.seek(0)
+            rom = f.read()
+        if magic[:2] == b'\x1f\x8b':
+            try:
+                rom = gzip.decompress(rom)
+            except (EOFError, zlib.error, gzip.BadGzipFile) as error:
+                raise ValueError('Corrupt gzip file: %s' % error)
         return rom
 
-    def load(self):
-        if(self.rom.read(3).decode('ascii') != 'NES'):
-            exit()
-        self.rom.seek(4)
-
-        self.prgRomCount =  ord(self.rom.read(1))
-        self.chrRomCount =  ord(self.rom.read(1))
-        self.flags6 = ord(self.rom.read(1))
-        self.flags7 = ord(self.rom.read(1))
-        self.prgRamCount = ord(self.rom.read(1))
-        self.flags9 = ord(self.rom.read(1))
-        self.flags10 = ord(self.rom.read(1))
+    # With a cached member index the central directory is not read again, the member is
+    # decompressed straight from its local header
+    def readZipMember(self, f):
+        members = self.archives.get(self.path) if self.archives is not None else None
+        if members is None:
+            with zipfile.ZipFile(f) as archive:
+                members = {info.filename: (info.header_offset, info.compress_type, info.compress_size,
+                                           info.file_size, info.CRC)
+                           for info in archive.infolist() if info.filename.lower().endswith('.nes')}
+            if self.archives is not None:
+                self.archives.put(self.path, members)
+
+        name = self.member if self.member is not None else next(iter(members), None)
+        if name not in members:
+            raise ValueError('No such .nes file in archive: %s' % (name or '*.nes'))
+        # Remember the member actually loaded, so the default one gets the same save file as naming it
+        self.member = name
+        offset, method, compressedSize, size, crc = members[name]
+
+        f.seek(offset)
+        local = f.read(30)
+        if len(local) < 30 or local[:4] != b'PK\x03\x04':
+            raise ValueError('Corrupt archive member: ' + name)
+        nameLength, extraLength = struct.unpack_from('<HH', local, 26)
+        f.seek(offset + 30 + nameLength + extraLength)
+        if method == zipfile.ZIP_STORED:
+            rom = f.read(compressedSize)
+        elif method == zipfile.ZIP_DEFLATED:
+            try:
+                rom = zlib.decompress(f.read(compressedSize), -15)
+            except zlib.error:
+                raise ValueError('Corrupt archive member: ' + name)
+        else:
+            with zipfile.ZipFile(f) as archive:
+                rom = archive.read(name)
 
-        self.mapperNumber = ((self.flags6 & 240) >> 4) + (self.flags7 & 240)
+        if len(rom) != size or zlib.crc32(rom) != crc:
+            raise ValueError('Corrupt archive member: ' + name)
+        return rom
 
-        self.rom.seek(16)
+    def load(self):
+        header = self.rom[:16]
+        if len(header) < 16 or header[:4] != b'NES\x1a':
+            raise ValueError('Not an iNES ROM')
+        self.parseHeader(header)
 
+        offset = 16
         if self.flags6 & 4:
-            self.trainerData = self.rom.read(0x200)
+            self.trainerData = self.rom[16:0x210]
+            offset = 0x210
+        data = memoryview(self.rom)[offset:]
+
+        # The CRC covers PRG and CHR together, so it still matches when the header splits them wrongly
+        self.crc = zlib.crc32(data[:self.prgRomSize + self.chrRomSize])
+        self.fixedByDatabase = False
+        if self.database is not None:
+            record = self.database.lookup(self.crc)
+            if record is None and len(data) != self.prgRomSize + self.chrRomSize:
+                record = self.database.lookup(zlib.crc32(data))
+            if record is not None:
+                self.applyRecord(record)
+
+        if len(data) < self.prgRomSize + self.chrRomSize:
+            raise ValueError('ROM data is truncated: %d of %d bytes' % (len(data), self.prgRomSize + self.chrRomSize))
+        self.prgRomData = list(data[:self.prgRomSize])
+        self.chrRomData = list(data[self.prgRomSize:self.prgRomSize + self.chrRomSize])
+
+    # Battery saves sit next to the ROM, named after the archive member for archives
+    def savePath(self):
+        name = os.path.basename(self.member) if self.member else os.path.basename(self.path)
+        return os.path.join(os.path.dirname(self.path), os.path.splitext(name)[0] + '.sav')
+
+    def parseHeader(self, header):
+        self.flags6 = header[6]
+        self.flags7 = header[7]
+        self.flags9 = header[9]
+        self.flags10 = header[10]
+        self.nes2 = (self.flags7 & 0x0C) == 0x08
+
+        self.mapperNumber = (self.flags6 >> 4) | (self.flags7 & 0xF0)
+        self.submapper = 0
+        self.mirror = 4 if self.flags6 & 8 else self.flags6 & 1
+        self.battery = bool(self.flags6 & 2)
+
+        if self.nes2:
+            self.mapperNumber |= (header[8] & 0x0F) << 8
+            self.submapper = header[8] >> 4
+            self.prgRomSize = self.romSize(header[4], header[9] & 0x0F, 0x4000)
+            self.chrRomSize = self.romSize(header[5], header[9] >> 4, 0x2000)
+            # RAM sizes are shift counts, 64 << shift bytes, 0 for none
+            self.prgRamSize, self.prgNvramSize = [64 << shift if shift else 0
+                                                  for shift in (header[10] & 0x0F, header[10] >> 4)]
+            self.chrRamSize, self.chrNvramSize = [64 << shift if shift else 0
+                                                  for shift in (header[11] & 0x0F, header[11] >> 4)]
+            self.timing = header[12] & 3
+        else:
+            # Old dumping tools wrote their name over bytes 7-15, the upper mapper nibble is junk then
+            if any(header[12:16]):
+                self.mapperNumber &= 0x0F
+            self.prgRomSize = header[4] * 0x4000
+            self.chrRomSize = header[5] * 0x2000
+            prgRam = (header[8] or 1) * 0x2000
+            self.prgRamSize, self.prgNvramSize = (0, prgRam) if self.battery else (prgRam, 0)
+            self.chrRamSize = 0 if self.chrRomSize else 0x2000
+            self.chrNvramSize = 0
+            self.timing = self.flags9 & 1
+
+        self.setSizes()
+
+    # Sizes are a count of units, or 2^E * (2M + 1) bytes when the NES 2.0 MSB nibble is $F
+    def romSize(self, lsb, msb, unit):
+        if msb == 0x0F:
+            return (1 << (lsb >> 2)) * ((lsb & 3) * 2 + 1)
+        return ((msb << 8) | lsb) * unit
+
+    def setSizes(self):
+        self.prgRomCount = self.prgRomSize // 0x4000
+        self.chrRomCount = self.chrRomSize // 0x2000
+        self.region = self.regions[self.timing]
+
+    def applyRecord(self, record):
+        (self.mapperNumber, self.submapper, self.mirror, self.prgRomSize,
+         self.chrRomSize, self.battery, self.timing) = record
+        if self.chrRomSize:
+            self.chrRamSize = 0
+        elif not self.chrRamSize:
+            self.chrRamSize = 0x2000
+        self.setSizes()
+        self.fixedByDatabase = True
+
+# .nes members of every archive opened so far, so later runs go straight to the member.
+# Entries are keyed by absolute path and dropped when the archive's size or mtime changes.
+class archiveIndex:
+    # Without a path the index only lives in memory
+    def __init__(self, path=None):
+        self.path = path
+        self.archives = {}
+        if path is not None:
+            try:
+                with open(path) as f:
+                    self.archives = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    def get(self, archivePath):
+        entry = self.archives.get(os.path.abspath(archivePath))
+        stat = os.stat(archivePath)
+        if entry is None or entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            return None
+        return entry['members']
+
+    def put(self, archivePath, members):
+        stat = os.stat(archivePath)
+        self.archives[os.path.abspath(archivePath)] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size,
+                                                       'members': members}
+        if self.path is None:
+            return
+        # The cache is only an optimization, a read-only location just disables it
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.archives, f)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError:
+            pass
 
-        self.mirror = self.flags6 & 1
+# Known-good header fields keyed by the CRC32 of PRG and CHR, used to fix bad headers.
+# The index file is a 12 byte header followed by fixed size records, read in one go at startup.
+class romDatabase:
+    magic = b'NESDB\x00\x01\x00'
+    # crc, mapper, submapper, mirroring, PRG-ROM in 16 KB units, CHR-ROM in 8 KB units, flags, timing
+    record = struct.Struct('<IHBBHHBB')
+
+    def __init__(self, path=None):
+        self.records = {}
+        if path is not None:
+            self.load(path)
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data[:8] != self.magic:
+            raise ValueError('Not a ROM database: ' + path)
+        count, = struct.unpack_from('<I', data, 8)
+        records = self.record.iter_unpack(data[12:12 + count * self.record.size])
+        self.records = {fields[0]: fields[1:] for fields in records}
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.magic + struct.pack('<I', len(self.records)))
+            for crc in sorted(self.records):
+                f.write(self.record.pack(crc, *self.records[crc]))
+
+    def add(self, crc, mapper, submapper=0, mirror=0, prgRomSize=0x8000, chrRomSize=0x2000, battery=False, timing=0):
+        self.records[crc] = (mapper, submapper, mirror, prgRomSize // 0x4000, chrRomSize // 0x2000, int(battery), timing)
+
+    # Fields in romLoader order: mapper, submapper, mirror, PRG size, CHR size, battery, timing
+    def lookup(self, crc):
+        fields = self.records.get(crc)
+        if fields is None:
+            return None
+        mapper, submapper, mirror, prgRom, chrRom, flags, timing = fields
+        return mapper, submapper, mirror, prgRom * 0x4000, chrRom * 0x2000, bool(flags & 1), timing
 
-        self.prgRomData = list(self.rom.read(0x4000 * self.prgRomCount))
-        self.chrRomData = list(self.rom.read(0x2000 * self.chrRomCount))
+#==================================================================================
+# LIBRARY
+#==================================================================================
+
+# Catalog rows of one ROM file, one row per .nes member for archives. Runs in the scanner's worker processes.
+def scanRomFile(path):
+    try:
+        stat = os.stat(path)
+    except OSError as error:
+        return [(path, '', None, None) + (None,) * 9 + (str(error),)]
+    archives = archiveIndex()
+
+    def scan(member):
+        try:
+            cart = romLoader(path, member=member, archives=archives)
+            cart.load()
+            return (path, member or '', stat.st_mtime_ns, stat.st_size, cart.crc, cart.mapperNumber,
+                    cart.submapper, cart.prgRomSize, cart.chrRomSize, cart.mirror, int(cart.battery),
+                    cart.region, int(cart.nes2), None)
+        # Any failure only marks this row, one damaged file must not abort the whole scan
+        except Exception as error:
+            return (path, member or '', stat.st_mtime_ns, stat.st_size) + (None,) * 9 + (str(error),)
+
+    rows = [scan(None)]
+    try:
+        members = archives.get(path)
+    except OSError:
+        members = None
+    if members:
+        names = list(members)
+        rows[0] = (path, names[0]) + rows[0][2:]
+        rows += [scan(name) for name in names[1:]]
+    return rows
+
+# Persistent SQLite catalog of a ROM collection. Listing reads only the catalog. Rescans parse
+# just the files whose mtime or size changed, in a process pool.
+class romLibrary:
+    extensions = ('.nes', '.zip', '.gz')
+    columns = ('path', 'member', 'mtime', 'size', 'crc', 'mapper', 'submapper', 'prgRomSize',
+               'chrRomSize', 'mirror', 'battery', 'region', 'nes2', 'error')
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS roms (path TEXT, member TEXT, mtime INTEGER, '
+                                    'size INTEGER, crc INTEGER, mapper INTEGER, submapper INTEGER, '
+                                    'prgRomSize INTEGER, chrRomSize INTEGER, mirror INTEGER, battery INTEGER, '
+                                    'region TEXT, nes2 INTEGER, error TEXT, PRIMARY KEY (path, member))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS romsByMapper ON roms (mapper)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS romsByCRC ON roms (crc)')
+
+    # Returns the number of files parsed again and the number dropped from the catalog
+    def scan(self, directories, workers=None):
+        known = dict(((row['path'], (row['mtime'], row['size']))
+                      for row in self.connection.execute('SELECT path, mtime, size FROM roms')))
+        roots = [os.path.join(os.path.abspath(directory), '') for directory in directories]
+        found = set()
+        changed = []
+        for root in roots:
+            for directory, subdirectories, files in os.walk(root):
+                for name in files:
+                    if not name.lower().endswith(self.extensions):
+                        continue
+                    path = os.path.join(directory, name)
+                    # Dangling links and files removed since the walk are left out of the catalog
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    found.add(path)
+                    if known.get(path) != (stat.st_mtime_ns, stat.st_size):
+                        changed.append(path)
+        removed = [path for path in known if path not in found and path.startswith(tuple(roots))]
+
+        rows = []
+        # Starting the pool costs more than parsing a handful of headers
+        if len(changed) < 16:
+            for path in changed:
+                rows += scanRomFile(path)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+                for fileRows in pool.map(scanRomFile, changed, chunksize=16):
+                    rows += fileRows
+
+        with self.connection:
+            self.connection.executemany('DELETE FROM roms WHERE path = ?', [(path,) for path in changed + removed])
+            self.connection.executemany('INSERT INTO roms VALUES (%s)' % ', '.join('?' * len(self.columns)), rows)
+        return len(changed), len(removed)
+
+    # Playable entries, optionally filtered by mapper and by a substring of the path or member name
+    def list(self, mapper=None, name=None):
+        query = 'SELECT * FROM roms WHERE error IS NULL'
+        parameters = []
+        if mapper is not None:
+            query += ' AND mapper = ?'
+            parameters.append(mapper)
+        if name:
+            query += ' AND (path LIKE ? OR member LIKE ?)'
+            parameters += ['%' + name + '%'] * 2
+        return self.connection.execute(query + ' ORDER BY path, member', parameters).fetchall()
+
+    def close(self):
+        self.connection.close()
 
 #==================================================================================
 # CPU
 #==================================================================================
 
 class cpu:
-    def __init__(self, cartridge):
-        self.ppu = ppu(self, cartridge)
+    def __init__(self, cartridge, video=None):
+        self.scanline = 0
+        self.cyclesClock = 0
+        self.ppu = ppu(self, cartridge, video)
+        self.apu = apu(self)
+        self.pacer = framePacer()
+        self.hud = perfHUD()
 
         self.registers = {
             'PC': 0,            # Program Counter
@@ -75,12 +402,18 @@ class cpu:
         }
 
         self.memory = [0x00] * 0x10000
-        self.scanline = 0
+        # Cartridge page table indexed by address >> 13: PRG-RAM at $6000, then the mapper's 8 KB
+        # PRG-ROM windows at $8000, $A000, $C000 and $E000. The first three entries are unused.
         self.cart = cartridge
+        self.prgRAM = workRAM(cartridge.savePath() if cartridge.battery else None)
+        self.prgPages = [None] * 3 + [self.prgRAM.data] + [[0x00] * 0x2000] * 4
         self.initMemory()
         self.registers['PC'] = self.dmaRAMRead(0xFFFC) | (self.dmaRAMRead(0xFFFD) << 8)
         self.count = 0
         self.z = 0
+        # IRQ sources holding the line low, sampled by the run loop at the end of every scanline:
+        # bit 0 mapper, bit 1 APU frame counter, bit 2 DMC
+        self.irq = 0
 
         self.instructions = {   0x00: BRK_Implied, 
                                 0x01: ORA_Indirect_X, 
@@ -318,15 +651,10 @@ class cpu:
         }
 
     def initMemory(self):
-        if self.cart.mapperNumber != 0:
-            print ("Mapper not available yet")
+        if self.cart.mapperNumber not in mappers:
+            print ("Mapper %d not available yet" % self.cart.mapperNumber)
             exit(1)
-
-        for i in range(len(self.cart.prgRomData)):
-            v = self.cart.prgRomData[i]
-            self.dmaRAMWrite(i + 0x8000, v)
-            if self.cart.prgRomCount == 1:
-                self.dmaRAMWrite(i + 0xC000, v)
+        self.mapper = mappers[self.cart.mapperNumber](self, self.cart)
 
         for i in range(0x20):
             self.dmaRAMWrite(i + 0x4000, 0xFF)
@@ -338,13 +666,32 @@ class cpu:
         self.registers['PC'] = self.dmaRAMRead(0xFFFA) | (self.dmaRAMRead(0xFFFB) << 8)
         self.z = 1
 
+    def doIRQ(self):
+        self.pushStack((self.registers['PC'] >> 8) & 0xFF)
+        self.pushStack(self.registers['PC'] & 0xFF)
+        self.pushStack(self.registers['P'] & ~0x10)
+        self.setStatus(self.statusFlags['i'], 1)
+        self.registers['PC'] = self.dmaRAMRead(0xFFFE) | (self.dmaRAMRead(0xFFFF) << 8)
+
     def dmaRAMWrite(self, address, value):
         self.memory[address] = value
 
     def dmaRAMRead(self, address):
+        if address >= 0x6000:
+            return self.prgPages[address >> 13][address & 0x1FFF]
         value = self.memory[address]
         return value
 
+    # The 256 bytes of a CPU page, as copied by OAM DMA
+    def dmaPage(self, page):
+        address = page << 8
+        if address >= 0x6000:
+            offset = address & 0x1FFF
+            return list(self.prgPages[address >> 13][offset:offset + 0x100])
+        if address < 0x2000:
+            address &= 0x7FF
+        return self.memory[address:address + 0x100]
+
     def writeMemory(self, address, value):
         global KeysBuffer__, ReadNumber__, LastWrote___
         if address < 0x2000:
@@ -369,19 +716,22 @@ class cpu:
                 self.ppu.writeVRAM(value)
             self.dmaRAMWrite(address, value)
         elif 0x4000 <= address < 0x4014 or address == 0x4015:
-            pass
+            self.apu.writeRegister(address, value)
         elif address == 0x4014:
             self.ppu.writeSprRamDMA(value)
             self.dmaRAMWrite(address, value)
         elif address == 0x4016 or address == 0x4017:
+            if address == 0x4017:
+                self.apu.writeRegister(address, value)
             if LastWrote___ == 1 and value == 0:
                 ReadNumber__ = 0
             LastWrote___ = value
             self.dmaRAMWrite(address, value)
         elif 0x6000 <= address < 0x8000:
-            pass
+            self.prgRAM.data[address & 0x1FFF] = value
+            self.prgRAM.dirtyPages.add((address & 0x1FFF) // mmap.PAGESIZE)
         elif 0x8000 <= address < 0x10000:
-            self.dmaRAMWrite(address, value)
+            self.mapper.writeRegister(address, value)
         else:
             print('Unhandled RAM write access')
 
@@ -398,14 +748,14 @@ class cpu:
             elif addrflag == 7:
                 value = self.ppu.readVRAM()
             self.dmaRAMWrite(address, value)
+        elif address == 0x4015:
+            value = self.apu.readStatus()
         elif address == 0x4016:
             Strobe()
             value = KeysBuffer__
         elif 0x4000 < address < 0x4020:
             value = self.dmaRAMRead(address)
-        elif 0x6000 <= address < 0x8000:
-            pass
-        elif 0x8000 <= address < 0x10000:
+        elif 0x6000 <= address < 0x10000:
             value = self.dmaRAMRead(address)
         else:
            print('Unhandled RAM read access')
@@ -435,56 +785,81 @@ class cpu:
 
     def run(self):
         global keys
-        cyclesClock = 0
+        self.cyclesClock = 0
         a = 0
-        loopCounter = 0
-        fpsCounter = 0
+        instructionCount = 0
         cyclesCounter = 0
-        timer = time.perf_counter()
         self.z = 0
         while True:
-            pygame.event.poll()
-
             instr = self.dmaRAMRead(self.registers['PC'])
             cycles = self.instructions[instr](self)
+            instructionCount += 1
+
+            self.cyclesClock += cycles
+            cyclesCounter = self.cyclesClock
 
-            cyclesClock += cycles
-            if (time.perf_counter() - timer) > 1:
-                fpsCounter = int(loopCounter/100)
-                timer = time.perf_counter()
-                loopCounter = 0
-            cyclesCounter = cyclesClock
+            if self.cyclesClock >= 113:
+                self.cyclesClock = 0
+                profiling = self.hud.visible
+                if profiling:
+                    lineStart = time.perf_counter()
 
-            if cyclesClock >= 113:
-                cyclesClock = 0
                 if 0 <= self.scanline < 240:
                     if self.ppu.VBlank:
                         self.ppu.exitVBlank()
                     self.ppu.doScanline()
+                    self.mapper.clockScanline()
                 elif self.scanline == 241:
-                    self.ppu.debugMsg("FPS: {0}".format(fpsCounter))
+                    if profiling and self.ppu.renderFrame:
+                        self.ppu.debugMsg(self.hud.text)
                     cyclesCounter = 0
                     self.ppu.enterVBlank()
-                    pygame.event.pump()
-                    keys = pygame.key.get_pressed()
-                    if keys[pygame.K_ESCAPE] == 1:
-                        pygame.quit()
-                        sys.exit()
+                    self.apu.endFrame()
+                    keys = self.ppu.video.pollInput()
+                    for hotkey in self.ppu.video.hotkeys:
+                        if hotkey == 'turbo':
+                            self.pacer.setTurbo(not self.pacer.turbo)
+                        elif hotkey == 'hud':
+                            self.hud.toggle()
+                            self.ppu.debugMsg(None)
+                        elif hotkey == 'palette' and self.ppu.debugViews is not None:
+                            self.ppu.debugViews.nextPalette()
+                    del self.ppu.video.hotkeys[:]
+                    self.pacer.wait()
+                    if self.ppu.frameCount % 60 == 0:
+                        self.prgRAM.flush()
+                    if profiling:
+                        self.hud.endFrame(instructionCount, self.pacer, self.ppu, self.apu)
+                    instructionCount = 0
                 elif self.scanline == 261:
+                    self.mapper.clockScanline()
                     self.scanline = -1
+                    self.ppu.startFrame()
                 self.scanline += 1
-                loopCounter+=1
+
+                if self.irq and not self.registers['P'] & 0x04:
+                    self.doIRQ()
+
+                if profiling:
+                    self.hud.scanlineTime += time.perf_counter() - lineStart
 
 #==================================================================================
 # PPU
 #==================================================================================
 
 class ppu:
-    def __init__(self, cpu, cartridge):
+    def __init__(self, cpu, cartridge, video=None):
         self.cpu = cpu
+        self.video = video if video is not None else pygameVideo()
+        self.recorder = None
+        self.debugViews = None
+        self.presentTime = 0.0
 
-        self.VRAM = [np.uint8(0x00)] * 0x10000
-        self.SPRRAM = [np.uint8(0x00)] * 0x100
+        self.VRAM = np.zeros(0x4000, dtype=np.uint8)
+        # Four physical 1 KB nametables, the logical $2000/$2400/$2800/$2C00 tables point into them
+        self.nameTableRAM = np.zeros((4, 0x400), dtype=np.uint8)
+        self.nameTableBanks = np.array([0, 0, 1, 1])
+        self.SPRRAM = np.zeros(0x100, dtype=np.uint8)
 
         self.nameTableAddress = 0
         self.incrementAddress = 1
@@ -492,7 +867,7 @@ class ppu:
         self.backgroundPatternTable = 0
         self.spriteSize = 8
         self.NMI = False
-        self.colorMode = True
+        self.colorMode = False
         self.clippingBackground = False
         self.clippingSprites = False
         self.showBackground = False
@@ -503,19 +878,60 @@ class ppu:
         self.vRamWrites = 0
         self.scanlineSpriteCount = 0
         self.sprite0Hit = 0
-        self.spriteHitOccured = False
+        self.sprite0HitCycle = -1
+        self.sprite0Stale = False
+        self.oamDirty = True
+        self.sprite0Line = -1
         self.VBlank = False
         self.VRAMAddress = 0
         self.VRAMBuffer = 0
         self.firstWrite = True
         self.ppuScrollX = 0
         self.ppuScrollY = 0
+        # Vertical scroll in use for the current frame, the PPU only reloads it before the first line
+        self.frameScrollY = 0
         self.ppuStarted = 0
+        self.renderedLine = 0
+
+        # Only one frame out of renderEvery is drawn, the others just keep $2002 state up to date
+        self.renderEvery = 1
+        self.frameCount = 0
+        self.renderFrame = True
 
         self.ppuMirroring = 0
-        self.addressMirroring = 0
 
         self.matrix = []
+        self.frameBuffer = np.full((240, 256), 0x0F, dtype=np.uint8)
+        self.tileCache = np.zeros((512, 8, 8), dtype=np.uint8)
+        # bitPlanes[byte] is the byte split into its 8 pixel bits, left to right
+        self.bitPlanes = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1)
+        # CHR-RAM rows (chrMemory offset of the low plane byte) written since the tile cache was last updated
+        self.dirtyPatternRows = set()
+        self.chrRAM = False
+        # CHR page table: chrBanks[slot] is the 1 KB bank of chrMemory seen at $0000 + slot * $400.
+        # chrTiles is the decoded cache of all of CHR, tileCache the 512 tiles currently mapped.
+        self.chrMemory = np.zeros(0x2000, dtype=np.uint8)
+        self.chrTiles = np.zeros((512, 8, 8), dtype=np.uint8)
+        self.chrBanks = np.arange(8)
+
+        # Attribute quadrant shift for every tile of a nametable
+        rows = np.arange(30)[:, None]
+        columns = np.arange(32)[None, :]
+        self.attributeShift = (((rows & 2) << 1) | (columns & 2)).astype(np.uint8)
+        # 2-bit palette of every tile, one 30x32 map per physical nametable, updated on attribute writes
+        self.paletteMaps = np.zeros((4, 30, 32), dtype=np.uint8)
+
+        # Palette indices of each physical nametable as a 256x240 image, redrawn per dirty tile
+        self.nameTableCache = np.zeros((4, 240, 256), dtype=np.uint8)
+        self.nameTableTiles = self.nameTableCache.reshape(4, 30, 8, 32, 8).swapaxes(2, 3)
+        self.dirtyTiles = np.ones((4, 30, 32), dtype=bool)
+        self.nameTableDirty = True
+        self.cachePatternTable = 0
+        self.screenRows = np.arange(240)
+        self.screenColumns = np.arange(256)
+        self.backgroundOpaque = np.zeros((240, 256), dtype=bool)
+        self.scanlineSprites = np.full((240, 8), 64)
+        self.lineSpriteCounts = np.zeros(240, dtype=np.intp)
 
         self.cart = cartridge
         self.initMemory()
@@ -585,48 +1001,129 @@ class ppu:
                              (0x00, 0x00, 0x00),
                              (0x00, 0x00, 0x00),
                              (0x00, 0x00, 0x00)]
+        self.buildPaletteLUT()
+
+    # paletteLUT[emphasis, color] for the 8 color emphasis settings, grayscaleLUT keeps only the luma column
+    def buildPaletteLUT(self):
+        colors = np.array(self.colorPallete, dtype=np.float64)
+        emphasis = np.arange(8)[:, None]
+        # Each emphasis bit (red, green, blue) dims the other two channels
+        dimmed = np.stack(((emphasis & 6) != 0, (emphasis & 5) != 0, (emphasis & 3) != 0), axis=-1)
+        attenuation = np.where(dimmed, 0.816328, 1.0)
+        self.paletteLUT = np.rint(colors[None, :, :] * attenuation).astype(np.uint8)
+        self.grayscaleLUT = self.paletteLUT[:, np.arange(64) & 0x30]
 
     def initMemory(self):
-        maxdata = len(self.cart.chrRomData)
-        for i in range(len(self.cart.chrRomData)):
-            v = self.cart.chrRomData[i]
-            self.dmaVRAMWrite(i, v)
+        # Carts without CHR-ROM have 8 KB of CHR-RAM written through $2007
+        self.chrRAM = self.cart.chrRomSize == 0
+        if self.chrRAM:
+            self.chrMemory = np.zeros(max(self.cart.chrRamSize + self.cart.chrNvramSize, 0x2000), dtype=np.uint8)
+        else:
+            self.chrMemory = np.array(self.cart.chrRomData, dtype=np.uint8)
+            # NES 2.0 allows CHR-ROM smaller than 8 KB, it is mirrored across the pattern tables
+            if len(self.chrMemory) < 0x2000:
+                self.chrMemory = np.resize(self.chrMemory, 0x2000)
+        self.chrBankCount = len(self.chrMemory) // 0x400
+        self.decodeTiles()
 
-        pygame.init()
-        self.screen = pygame.display.set_mode((256, 240))
-        self.layerB = pygame.Surface((256,240))
-        self.layerA = pygame.Surface((256,240), pygame.SRCALPHA)
-        self.debugLayer = pygame.Surface((256,240), pygame.SRCALPHA)
-        self.layerB.fill((0, 0, 0))
-        self.layerA.fill((0, 0, 0, 0))
-        self.debugLayer.fill((0,0,0,0))
-        self.screen.blit(self.layerB, (0,0))
-        self.screen.blit(self.layerA, (0,0))
-        self.screen.blit(self.debugLayer, (0,0))
-        pygame.display.flip()
+        self.video.open()
 
     def dmaVRAMWrite(self, address, value):
-        self.VRAM[address] = value
+        if address < 0x2000:
+            self.chrMemory[self.chrAddress(address)] = value
+        else:
+            self.VRAM[address] = value
 
     def dmaVRAMRead(self, address):
-        value = self.VRAM[address]
+        if address < 0x2000:
+            return int(self.chrMemory[self.chrAddress(address)])
+        value = int(self.VRAM[address])
         return value
 
+    # Offset in chrMemory of a pattern table address, through the CHR page table
+    def chrAddress(self, address):
+        return int(self.chrBanks[address >> 10]) * 0x400 + (address & 0x3FF)
+
+    def decodeTiles(self):
+        # chrTiles[tile, row, column] holds the 2-bit color of each pattern pixel
+        tileCount = len(self.chrMemory) // 16
+        planes = np.unpackbits(self.chrMemory.reshape(tileCount, 2, 8), axis=2).reshape(tileCount, 2, 8, 8)
+        self.chrTiles = planes[:, 0] | (planes[:, 1] << 1)
+        self.tileCache = self.chrTiles[(self.chrBanks[:, None] * 64 + np.arange(64)).ravel()]
+        self.dirtyPatternRows.clear()
+
+    # Map a 1 KB CHR bank into a pattern table slot, only its 64 decoded tiles are copied into tileCache
+    def setChrBank(self, slot, bank):
+        bank %= self.chrBankCount
+        if self.chrBanks[slot] == bank:
+            return
+        self.syncBackground()
+        self.updateTileCache()
+        self.chrBanks[slot] = bank
+        self.tileCache[slot * 64:slot * 64 + 64] = self.chrTiles[bank * 64:bank * 64 + 64]
+
+        # Compared with the table the cache was drawn from, the selected one may have changed since
+        if (slot >> 2) == (self.cachePatternTable >> 12):
+            self.dirtyTiles |= ((self.nameTableRAM[:, :0x3C0] >> 6) == (slot & 3)).reshape(4, 30, 32)
+            self.nameTableDirty = True
+        if not self.sprite0Hit:
+            self.sprite0Stale = True
+
+    # Decode only the CHR-RAM rows written since the last update and redraw the background tiles using them
+    def updateTileCache(self):
+        if not self.dirtyPatternRows:
+            return
+
+        rows = np.fromiter(self.dirtyPatternRows, dtype=np.intp, count=len(self.dirtyPatternRows))
+        self.dirtyPatternRows.clear()
+        self.chrTiles[rows >> 4, rows & 7] = \
+            self.bitPlanes[self.chrMemory[rows]] | (self.bitPlanes[self.chrMemory[rows + 8]] << 1)
+
+        # A bank may be mapped in several slots
+        changed, slots = np.nonzero((rows >> 10)[:, None] == self.chrBanks[None, :])
+        rows = rows[changed]
+        tiles = (slots << 6) | ((rows >> 4) & 63)
+        self.tileCache[tiles, rows & 7] = self.chrTiles[rows >> 4, rows & 7]
+
+        backgroundTiles = tiles[(tiles & 0x100) == (self.cachePatternTable >> 4)] & 0xFF
+        if len(backgroundTiles):
+            self.dirtyTiles |= np.isin(self.nameTableRAM[:, :0x3C0], backgroundTiles).reshape(4, 30, 32)
+            self.nameTableDirty = True
+
 
     def dmaSPRRAMWrite(self, address, value):
         self.SPRRAM[address] = value
 
     def dmaSPRRAMRead(self, address):
-        value = self.SPRRAM[address]
+        value = int(self.SPRRAM[address])
         return value
 
     def setMirroring(self, mirroring):
         # 0: horizontal mirroring
         # 1: vertical mirroring
+        # 2: single screen, lower bank
+        # 3: single screen, upper bank
+        # 4: four screen
+        banks = {0: [0, 0, 1, 1],
+                 1: [0, 1, 0, 1],
+                 2: [0, 0, 0, 0],
+                 3: [1, 1, 1, 1],
+                 4: [0, 1, 2, 3]}
+        self.syncBackground()
         self.ppuMirroring = mirroring
-        self.addressMirroring = 0x400 << self.ppuMirroring
+        self.nameTableBanks[:] = banks[mirroring]
+
+    def readNameTable(self, address):
+        return int(self.nameTableRAM[self.nameTableBanks[(address >> 10) & 3], address & 0x3FF])
+
+    def writeNameTable(self, address, value):
+        bank = self.nameTableBanks[(address >> 10) & 3]
+        self.nameTableRAM[bank, address & 0x3FF] = value
+        self.markNameTableDirty(bank, address & 0x3FF)
 
     def processControlReg1(self, value):
+        self.syncBackground()
+
         # Check bits 0-1
         aux = value & 0x3
         if aux == 0:
@@ -657,10 +1154,13 @@ class ppu:
             self.backgroundPatternTable = 0x0000
 
         # Check bit 5
+        spriteSize = self.spriteSize
         if value & (1 << 5):
             self.spriteSize = 16
         else:
             self.spriteSize = 8
+        if self.spriteSize != spriteSize:
+            self.oamDirty = True
 
         # Bit 6 not used
         # Check bit 7
@@ -670,6 +1170,8 @@ class ppu:
             self.NMI = False
 
     def processControlReg2(self, value):
+        self.syncBackground()
+
         # Check bit 0
         if value & 1:
             self.colorMode = True
@@ -705,6 +1207,7 @@ class ppu:
 
     # process register 0x2005
     def processPPUSCROLL(self, value):
+        self.syncBackground()
         if self.firstWrite:
             self.ppuScrollX = value
             self.firstWrite = False
@@ -723,13 +1226,19 @@ class ppu:
 
     # process register 0x2007 (write)
     def writeVRAM(self, value):
-        # NameTable write mirroring.
-        if self.VRAMAddress >= 0x2000 and self.VRAMAddress < 0x3F00:
-            self.dmaVRAMWrite(self.VRAMAddress + self.addressMirroring, value)
-            self.dmaVRAMWrite(self.VRAMAddress, value)
+        self.syncBackground()
+        address = self.VRAMAddress & 0x3FFF
+        if address < 0x2000:
+            if self.chrRAM:
+                self.dmaVRAMWrite(address, value)
+                self.dirtyPatternRows.add(self.chrAddress(address) & ~8)
+
+        # NameTable writes go through the bank pointers.
+        elif address >= 0x2000 and address < 0x3F00:
+            self.writeNameTable(address, value)
 
-        elif self.VRAMAddress >= 0x3F00 and self.VRAMAddress < 0x3F20:
-            if self.VRAMAddress == 0x3F00 or self.VRAMAddress == 0x3F10:
+        elif address >= 0x3F00 and address < 0x3F20:
+            if address == 0x3F00 or address == 0x3F10:
                 self.dmaVRAMWrite(0x3F00, value)
                 self.dmaVRAMWrite(0x3F04, value)
                 self.dmaVRAMWrite(0x3F08, value)
@@ -739,7 +1248,7 @@ class ppu:
                 self.dmaVRAMWrite(0x3F18, value)
                 self.dmaVRAMWrite(0x3F1C, value)
             else:
-                self.dmaVRAMWrite(self.VRAMAddress, value)
+                self.dmaVRAMWrite(address, value)
 
         self.VRAMAddress += self.incrementAddress
 
@@ -751,7 +1260,10 @@ class ppu:
             address = 0x3F00 + (address & 0xF)
             self.VRAMBuffer = self.dmaVRAMRead(address)
             value = self.dmaVRAMRead(address)
-        elif address < 0x3F00:
+        elif address >= 0x2000:
+            value = self.VRAMBuffer
+            self.VRAMBuffer = self.readNameTable(address)
+        else:
             value = self.VRAMBuffer
             self.VRAMBuffer = self.dmaVRAMRead(address)
         self.VRAMAddress += self.incrementAddress
@@ -761,15 +1273,17 @@ class ppu:
     def writeSprRam(self, value):
         self.dmaSPRRAMWrite(self.spriteRamAddr,value)
         self.spriteRamAddr = (self.spriteRamAddr + 1) & 0xFF
+        self.oamDirty = True
+        self.sprite0Stale = True
 
     def writeSprRamDMA(self, value):
-        address = value * 0x100
-
-        for i in range(256):
-            self.dmaSPRRAMWrite(i, self.cpu.dmaRAMRead(address))
-            address += 1
+        self.SPRRAM[:] = self.cpu.dmaPage(value)
+        self.oamDirty = True
+        self.sprite0Stale = True
 
     def readStatusFlag(self):
+        self.updateSprite0Hit()
+
         value = 0
         value |= (self.vRamWrites << 4)
         value |= (self.scanlineSpriteCount << 5)
@@ -782,166 +1296,939 @@ class ppu:
         return value
 
     def doScanline(self):
+        if self.oamDirty:
+            self.evaluateSprites()
+
+        line = self.cpu.scanline
+        if line == 0:
+            self.scanlineSpriteCount = 0
+        if self.showSprites and self.lineSpriteCounts[line] > 8:
+            self.scanlineSpriteCount = 1
+
+        if self.sprite0HitCycle >= 0 or self.sprite0Stale:
+            self.updateSprite0Hit()
+
+        # Without mid-frame writes the whole frame is drawn here in one pass
+        if line == 239 and self.renderFrame:
+            self.flushBackground(240)
+            if self.showSprites:
+                self.drawSprites()
+        if line == 239:
+            self.renderedLine = 0
+
+    # Draw the lines rendered so far with the current state before a register write changes it
+    def syncBackground(self):
+        if 0 <= self.cpu.scanline < 240:
+            if self.renderFrame:
+                self.flushBackground(self.cpu.scanline)
+            if not self.sprite0Hit:
+                self.sprite0Stale = True
+
+    def flushBackground(self, line):
+        if line <= self.renderedLine:
+            return
 
         if self.showBackground:
-            self.drawBackground()
-
-        if self.showSprites:
-            self.drawSprites()
-
-    def drawBackground(self):
-        matrix = pygame.PixelArray(self.layerB)
-        tileY = int(self.cpu.scanline / 8)
-        Y = int(self.cpu.scanline % 8)
-
-        maxTiles = 32
-        if (self.ppuScrollX % 8) != 0:
-            maxTiles = 33
-
-        currentTile = int(self.ppuScrollX / 8)
-        v = int(self.nameTableAddress + currentTile)
-        pixel = 0
-
-        i=0 if self.clippingBackground else 1
-        while i < maxTiles:
-
-            fromByte = 0
-            toByte = 8
-
-            ppuScrollFlag = (self.ppuScrollX %8)
-            if ppuScrollFlag != 0:
-                if i == 0:
-                    toByte = 7 - (ppuScrollFlag)
-                if i == (maxTiles - 1):
-                    fromByte = 8 - (ppuScrollFlag)
-
-            ptrAddress = self.dmaVRAMRead(v + int(tileY*0x20))
-            pattern1 = self.dmaVRAMRead(self.backgroundPatternTable + (ptrAddress*16) + Y)
-            pattern2 = self.dmaVRAMRead(self.backgroundPatternTable + (ptrAddress*16) + Y + 8)
-            # blockX and blockY block coodinate
-            blockX = i % 4
-            blockY = tileY % 4
-            block = int(i / 4) + (int(tileY / 4) * 8)
-            addressByte = int((v & ~0x001F) + 0x03C0 + block)
-            byteAttributeTable = self.dmaVRAMRead(addressByte)
-            colorIndex = 0x3F00
-
-            if blockX < 2:
-                if blockY >= 2:
-                    colorIndex |= ((byteAttributeTable & 0b110000) >> 4) << 2
-                else:
-                    colorIndex |= (byteAttributeTable & 0b11) << 2
-            elif blockX >= 2 and blockY < 2:
-                colorIndex |= ((byteAttributeTable & 0b1100) >> 2) << 2
+            self.drawBackground(self.renderedLine, line)
+        else:
+            self.frameBuffer[self.renderedLine:line] = 0x0F
+            self.backgroundOpaque[self.renderedLine:line] = False
+        self.renderedLine = line
+
+    def markNameTableDirty(self, bank, offset):
+        if offset < 0x3C0:
+            self.dirtyTiles[bank, offset >> 5, offset & 0x1F] = True
+        else:
+            # An attribute byte colors a 4x4 tile block, the last row of blocks is cut to 2 tiles
+            block = offset - 0x3C0
+            tileY = (block >> 3) * 4
+            tileX = (block & 7) * 4
+            self.paletteMaps[bank, tileY:tileY + 4, tileX:tileX + 4] = \
+                (self.nameTableRAM[bank, offset] >> self.attributeShift[tileY:tileY + 4, tileX:tileX + 4]) & 3
+            self.dirtyTiles[bank, tileY:tileY + 4, tileX:tileX + 4] = True
+        self.nameTableDirty = True
+
+    def updateNameTableCache(self):
+        self.updateTileCache()
+        if self.backgroundPatternTable != self.cachePatternTable:
+            self.cachePatternTable = self.backgroundPatternTable
+            self.dirtyTiles[:] = True
+            self.nameTableDirty = True
+
+        if not self.nameTableDirty:
+            return
+
+        banks, tileY, tileX = np.nonzero(self.dirtyTiles)
+        tiles = self.nameTableRAM[banks, (tileY * 0x20) + tileX].astype(np.intp)
+        tiles += self.backgroundPatternTable >> 4
+        palettes = self.paletteMaps[banks, tileY, tileX]
+
+        pixels = self.tileCache[tiles]
+        self.nameTableTiles[banks, tileY, tileX] = np.where(pixels, (palettes[:, None, None] << 2) | pixels, 0)
+
+        self.dirtyTiles[:] = False
+        self.nameTableDirty = False
+
+    # Palette indices of the visible background lines, a window into the nametable cache
+    def backgroundLines(self, firstLine, lastLine):
+        self.updateNameTableCache()
+
+        # The screen is a 256x240 window wrapping around the 2x2 grid of logical nametables
+        originY = ((self.nameTableAddress >> 11) & 1) * 240 + self.frameScrollY
+        originX = ((self.nameTableAddress >> 10) & 1) * 256 + self.ppuScrollX
+        rows = (self.screenRows[firstLine:lastLine] + originY) % 480
+        columns = (self.screenColumns + originX) & 0x1FF
+
+        banks = self.nameTableBanks[((rows >= 240) * 2)[:, None] + (columns >= 256)]
+        lines = self.nameTableCache[banks, (rows % 240)[:, None], columns & 0xFF]
+        if not self.clippingBackground:
+            lines[:, :8] = 0
+        return lines
+
+    def drawBackground(self, firstLine, lastLine):
+        lines = self.backgroundLines(firstLine, lastLine)
+        self.backgroundOpaque[firstLine:lastLine] = lines != 0
+        self.frameBuffer[firstLine:lastLine] = self.VRAM[0x3F00:0x3F10][lines] & 0x3F
+
+    def startFrame(self):
+        self.frameCount += 1
+        self.renderFrame = self.frameCount % self.renderEvery == 0
+        self.frameScrollY = self.ppuScrollY
+        self.sprite0Hit = 0
+        self.predictSprite0Hit(0)
+
+    # Find the first dot where an opaque sprite 0 pixel meets an opaque background pixel
+    def predictSprite0Hit(self, firstLine):
+        self.sprite0Stale = False
+        self.sprite0HitCycle = -1
+        if not (self.showBackground and self.showSprites):
+            return
+
+        if self.oamDirty:
+            self.evaluateSprites()
+        self.updateTileCache()
+        top = self.sprite0Line
+        firstLine = max(firstLine, top)
+        lastLine = min(top + self.spriteSize, 240)
+        if top < 0 or firstLine >= lastLine:
+            return
+
+        tile = int(self.SPRRAM[1])
+        attributes = int(self.SPRRAM[2])
+        row = self.screenRows[firstLine:lastLine] - top
+        if attributes & 0x80:
+            row = self.spriteSize - 1 - row
+        if self.spriteSize == 16:
+            tiles = ((tile & 1) << 8) | (tile & 0xFE) | ((row >> 3) & 1)
+        else:
+            tiles = (self.spritePatternTable >> 4) + tile
+
+        pixels = self.tileCache[tiles, row & 7]
+        if attributes & 0x40:
+            pixels = pixels[:, ::-1]
+
+        # No hit at x=255, nor in the left 8 pixels when either layer is clipped there
+        columns = int(self.SPRRAM[3]) + np.arange(8)
+        sprite = (pixels != 0) & (columns < 255)
+        if not self.clippingSprites:
+            sprite &= columns >= 8
+        background = self.backgroundLines(firstLine, lastLine)[:, np.minimum(columns, 255)]
+
+        hits = np.argwhere(sprite & (background != 0))
+        if len(hits):
+            line, offset = hits[0]
+            self.sprite0HitCycle = (firstLine + line) * 113 + (columns[offset] + 1) // 3
+
+    # Raise the $2002 sprite 0 flag once the CPU has reached the predicted cycle
+    def updateSprite0Hit(self):
+        if self.sprite0Stale and not self.sprite0Hit and 0 <= self.cpu.scanline < 240:
+            self.predictSprite0Hit(self.cpu.scanline)
+
+        if 0 <= self.sprite0HitCycle <= self.cpu.scanline * 113 + self.cpu.cyclesClock:
+            self.sprite0Hit = 1
+            self.sprite0HitCycle = -1
+
+    # Build the scanline to sprites table: the first 8 sprites in OAM order on every line
+    def evaluateSprites(self):
+        top = self.SPRRAM[0::4].astype(np.intp)
+        lines = self.screenRows[:, None]
+        inRange = (lines >= top) & (lines < top + self.spriteSize) & (top < 0xEF)
+        self.lineSpriteCounts = inRange.sum(axis=1)
+
+        inRange &= np.cumsum(inRange, axis=1) <= 8
+        order = np.argsort(~inRange, axis=1, kind='stable')[:, :8]
+        self.scanlineSprites = np.where(np.take_along_axis(inRange, order, axis=1), order, 64)
+
+        self.sprite0Line = int(top[0]) if top[0] < 0xEF else -1
+        self.oamDirty = False
+
+    def drawSprites(self):
+        if self.oamDirty:
+            self.evaluateSprites()
+        self.updateTileCache()
+
+        oam = self.SPRRAM.reshape(64, 4).astype(np.intp)
+        colors = np.zeros((240, 256 + 8), dtype=np.uint8)
+        behind = np.zeros((240, 256 + 8), dtype=bool)
+
+        # Lower OAM slots are drawn last so their opaque pixels cover the sprites after them
+        for slot in range(7, -1, -1):
+            sprites = self.scanlineSprites[:, slot]
+            visible = sprites < 64
+            if not visible.any():
+                continue
+
+            sprite = oam[sprites & 63]
+            attributes = sprite[:, 2]
+            row = self.screenRows - sprite[:, 0]
+            row = np.where(attributes & 0x80, self.spriteSize - 1 - row, row)
+            if self.spriteSize == 16:
+                tiles = ((sprite[:, 1] & 1) << 8) | (sprite[:, 1] & 0xFE) | ((row >> 3) & 1)
             else:
-                colorIndex |= ((byteAttributeTable & 0b11000000) >> 6) << 2
+                tiles = (self.spritePatternTable >> 4) + sprite[:, 1]
 
-            for j in range(fromByte, toByte):
-                bit1 = ((1 << j) & pattern1) >> j
-                bit2 = ((1 << j) & pattern2) >> j
-                colorIndexFinal = colorIndex
-                colorIndexFinal |= ((bit2 << 1) | bit1)
+            pixels = self.tileCache[tiles, row & 7]
+            pixels = np.where((attributes & 0x40)[:, None] != 0, pixels[:, ::-1], pixels)
 
-                color = self.colorPallete[self.dmaVRAMRead(colorIndexFinal)]
-                x = (pixel + ((j * (-1)) + (toByte - fromByte) - 1))
-                y = self.cpu.scanline
+            lines, offsets = np.nonzero((pixels != 0) & visible[:, None])
+            columns = sprite[lines, 3] + offsets
+            colors[lines, columns] = ((attributes[lines] & 3) << 2) | pixels[lines, offsets]
+            behind[lines, columns] = (attributes[lines] & 0x20) != 0
 
-                if (color != matrix[x][y]):
-                    matrix[x][y] = color
+        colors = colors[:, :256]
+        if not self.clippingSprites:
+            colors[:, :8] = 0
+        shown = (colors != 0) & ~(behind[:, :256] & self.backgroundOpaque)
+        self.frameBuffer[shown] = self.VRAM[0x3F10:0x3F20][colors[shown]] & 0x3F
 
-            pixel += toByte - fromByte
+    def enterVBlank(self):
+        if self.NMI:
+            self.cpu.doNMI()
 
-            if (v & 0x001f) == 31:
-                v &= ~0x001F
-                v ^= 0x400
-            else:
-                v += 1
-            i+=1
-        del matrix
+        self.VBlank = True
+        if self.debugViews is not None:
+            self.debugViews.endFrame()
+        if not self.renderFrame:
+            return
+
+        frame = self.frameRGB()
+        presentStart = time.perf_counter()
+        self.video.present(frame)
+        if self.recorder is not None:
+            self.recorder.push(frame)
+        self.presentTime += time.perf_counter() - presentStart
+
+    def frameRGB(self):
+        palette = self.grayscaleLUT if self.colorMode else self.paletteLUT
+        return palette[self.colorIntensity].take(self.frameBuffer, axis=0)
 
-    def drawSprites(self):
-        numberSpritesPerScanline = 0
-        Y = self.cpu.scanline % 8
-        secondaryOAM = [0xFF] * 32
-        indexSecondaryOAM = 0
+    def exitVBlank(self):
+        self.VBlank = False
 
-        for currentSprite in range(0, 256, 4):
-            spriteY = self.dmaSPRRAMRead(currentSprite)
+    def debugMsg(self, msg):
+        self.video.debugMsg(msg)
 
-            if numberSpritesPerScanline == 8:
-                break
+#==================================================================================
+# APU
+#==================================================================================
 
-            if spriteY <= self.cpu.scanline < spriteY + self.spriteSize:
-                for i in range(4):
-                    secondaryOAM[indexSecondaryOAM + i] = self.dmaSPRRAMRead(currentSprite+i)
-                indexSecondaryOAM += 4
-                numberSpritesPerScanline += 1
+lengthTable = [10, 254, 20, 2, 40, 4, 80, 6, 160, 8, 60, 10, 14, 12, 26, 14,
+               12, 16, 24, 18, 48, 20, 96, 22, 192, 24, 72, 26, 16, 28, 32, 30]
 
-        for currentSprite in range(28, -1, -4):
-            spriteX = secondaryOAM[currentSprite + 3]
-            spriteY = secondaryOAM[currentSprite]
+# Length counter and envelope shared by the pulse and noise channels
+class envelopeChannel:
+    def __init__(self):
+        self.enabled = False
+        self.length = 0
+        self.halt = False
+        self.constant = False
+        self.volume = 0
+        self.envelopeStart = False
+        self.envelopeDivider = 0
+        self.decay = 0
+
+    def writeControl(self, value):
+        self.halt = bool(value & 0x20)
+        self.constant = bool(value & 0x10)
+        self.volume = value & 0x0F
+
+    def loadLength(self, value):
+        if self.enabled:
+            self.length = lengthTable[value >> 3]
+        self.envelopeStart = True
+
+    def quarterFrame(self):
+        if self.envelopeStart:
+            self.envelopeStart = False
+            self.decay = 15
+            self.envelopeDivider = self.volume
+        elif self.envelopeDivider:
+            self.envelopeDivider -= 1
+        else:
+            self.envelopeDivider = self.volume
+            if self.decay:
+                self.decay -= 1
+            elif self.halt:
+                self.decay = 15
+
+    def halfFrame(self):
+        if self.length and not self.halt:
+            self.length -= 1
+
+    def level(self):
+        if not self.length:
+            return 0
+        return self.volume if self.constant else self.decay
+
+class pulseChannel(envelopeChannel):
+    duties = np.array([[0, 1, 0, 0, 0, 0, 0, 0],
+                       [0, 1, 1, 0, 0, 0, 0, 0],
+                       [0, 1, 1, 1, 1, 0, 0, 0],
+                       [1, 0, 0, 1, 1, 1, 1, 1]], dtype=np.uint8)
+
+    # Pulse 1 negates its sweep with ones' complement, pulse 2 with two's complement
+    def __init__(self, onesComplement):
+        envelopeChannel.__init__(self)
+        self.onesComplement = onesComplement
+        self.duty = 0
+        self.timer = 0
+        self.sweepEnabled = False
+        self.sweepPeriod = 0
+        self.sweepNegate = False
+        self.sweepShift = 0
+        self.sweepReload = False
+        self.sweepDivider = 0
+        self.phase = 0.0
+
+    def write(self, register, value):
+        if register == 0:
+            self.duty = value >> 6
+            self.writeControl(value)
+        elif register == 1:
+            self.sweepEnabled = bool(value & 0x80)
+            self.sweepPeriod = (value >> 4) & 7
+            self.sweepNegate = bool(value & 8)
+            self.sweepShift = value & 7
+            self.sweepReload = True
+        elif register == 2:
+            self.timer = (self.timer & 0x700) | value
+        else:
+            self.timer = (self.timer & 0xFF) | ((value & 7) << 8)
+            self.loadLength(value)
+
+    def sweepTarget(self):
+        change = self.timer >> self.sweepShift
+        if self.sweepNegate:
+            return self.timer - change - self.onesComplement
+        return self.timer + change
+
+    def halfFrame(self):
+        envelopeChannel.halfFrame(self)
+        if self.sweepDivider == 0 and self.sweepEnabled and self.sweepShift and not self.muted():
+            self.timer = self.sweepTarget()
+        if self.sweepDivider == 0 or self.sweepReload:
+            self.sweepDivider = self.sweepPeriod
+            self.sweepReload = False
+        else:
+            self.sweepDivider -= 1
 
-            if spriteY >= 0xEF or spriteX >= 0xF9:
-                continue
+    def muted(self):
+        return self.timer < 8 or self.sweepTarget() > 0x7FF
 
-            currentSpriteAddress = currentSprite + 2
-            flipVertical = secondaryOAM[currentSpriteAddress] & 0x80
-            flipHorizontal = secondaryOAM[currentSpriteAddress] & 0x40
+    # Waveform periods per CPU cycle, output level and duty for the span until the next change
+    def state(self):
+        return 1.0 / (16 * (self.timer + 1)), 0 if self.muted() else self.level(), self.duty
 
-            Y = self.cpu.scanline - spriteY
+    def render(self, steps, levels, duties):
+        phase = self.phase + np.cumsum(steps) - steps
+        if len(steps):
+            self.phase = (phase[-1] + steps[-1]) % 1.0
+        return self.duties[duties, (phase * 8).astype(np.intp) & 7] * levels
 
-            ptrAddress = secondaryOAM[currentSprite + 1]
-            patAddress = self.spritePatternTable + (ptrAddress * 16) + ((7 - Y) if flipVertical else Y)
-            pattern1 = self.dmaVRAMRead(patAddress)
-            pattern2 = self.dmaVRAMRead(patAddress + 8)
-            colorIndex = 0x3F10
+class triangleChannel:
+    sequence = np.array(list(range(15, -1, -1)) + list(range(16)), dtype=np.uint8)
 
-            colorIndex |= ((secondaryOAM[currentSprite +2] & 0x3) << 2)
+    def __init__(self):
+        self.enabled = False
+        self.length = 0
+        self.control = False
+        self.linearReload = 0
+        self.linear = 0
+        self.reloadLinear = False
+        self.timer = 0
+        self.phase = 0.0
+
+    def write(self, register, value):
+        if register == 0:
+            self.control = bool(value & 0x80)
+            self.linearReload = value & 0x7F
+        elif register == 2:
+            self.timer = (self.timer & 0x700) | value
+        elif register == 3:
+            self.timer = (self.timer & 0xFF) | ((value & 7) << 8)
+            if self.enabled:
+                self.length = lengthTable[value >> 3]
+            self.reloadLinear = True
+
+    def quarterFrame(self):
+        if self.reloadLinear:
+            self.linear = self.linearReload
+        elif self.linear:
+            self.linear -= 1
+        if not self.control:
+            self.reloadLinear = False
+
+    def halfFrame(self):
+        if self.length and not self.control:
+            self.length -= 1
+
+    # A silenced triangle stops where it is instead of dropping to 0, ultrasonic periods are held too
+    def state(self):
+        if not (self.length and self.linear) or self.timer < 2:
+            return 0.0
+        return 1.0 / (32 * (self.timer + 1))
+
+    def render(self, steps):
+        phase = self.phase + np.cumsum(steps) - steps
+        if len(steps):
+            self.phase = (phase[-1] + steps[-1]) % 1.0
+        return self.sequence[(phase * 32).astype(np.intp) & 31]
+
+class noiseChannel(envelopeChannel):
+    periods = [4, 8, 16, 32, 64, 96, 128, 160, 202, 254, 380, 508, 762, 1016, 2034, 4068]
 
-            for j in range(8):
-                if flipHorizontal:
-                    colorIndexFinal = (pattern1 >> j) & 0x1
-                    colorIndexFinal |= ((pattern2 >> j) & 0x1 ) << 1
-                else:
-                    colorIndexFinal = (pattern1 >> (7 - j)) & 0x1
-                    colorIndexFinal |= ((pattern2 >> (7 - j)) & 0x1) << 1
+    def __init__(self):
+        envelopeChannel.__init__(self)
+        self.mode = 0
+        self.period = self.periods[0]
+        self.position = 0.0
+        # Output of the 15-bit LFSR over a full cycle, for the long and the short (bit 6 feedback) mode
+        self.sequences = [self.lfsrSequence(1), self.lfsrSequence(6)]
+
+    def lfsrSequence(self, tap):
+        shift = 1
+        bits = []
+        while True:
+            bits.append(1 - (shift & 1))
+            feedback = (shift ^ (shift >> tap)) & 1
+            shift = (shift >> 1) | (feedback << 14)
+            if shift == 1:
+                return np.array(bits, dtype=np.uint8)
+
+    def write(self, register, value):
+        if register == 0:
+            self.writeControl(value)
+        elif register == 2:
+            self.mode = value >> 7
+            self.period = self.periods[value & 0x0F]
+        elif register == 3:
+            self.loadLength(value)
+
+    def state(self):
+        return 1.0 / self.period, self.level(), self.mode
+
+    def render(self, steps, levels, modes):
+        position = self.position + np.cumsum(steps) - steps
+        if len(steps):
+            self.position = (position[-1] + steps[-1]) % len(self.sequences[0])
+        index = position.astype(np.intp)
+        long, short = self.sequences
+        return np.where(modes, short[index % len(short)], long[index % len(long)]) * levels
+
+class dmcChannel:
+    rates = [428, 380, 340, 320, 286, 254, 226, 214, 190, 160, 142, 128, 106, 84, 72, 54]
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.irqEnabled = False
+        self.irqFlag = False
+        self.loop = False
+        self.rate = self.rates[0]
+        self.output = 0
+        self.sampleAddress = 0xC000
+        self.sampleLength = 1
+        self.address = 0xC000
+        self.remaining = 0
+        self.shift = 0
+        self.bits = 0
+        self.counter = 0
+        # (cycle, level) changes of the output during the current frame
+        self.changes = []
+
+    def write(self, register, value):
+        if register == 0:
+            self.irqEnabled = bool(value & 0x80)
+            self.loop = bool(value & 0x40)
+            self.rate = self.rates[value & 0x0F]
+            if not self.irqEnabled:
+                self.irqFlag = False
+                self.cpu.irq &= ~4
+        elif register == 1:
+            self.output = value & 0x7F
+        elif register == 2:
+            self.sampleAddress = 0xC000 | (value << 6)
+        else:
+            self.sampleLength = (value << 4) | 1
+
+    def restart(self):
+        self.address = self.sampleAddress
+        self.remaining = self.sampleLength
+
+    # Clock the output unit over cycles [start, end), one bit per rate cycles. Sample bytes are read
+    # with the current PRG mapping, changes of the output level are recorded for the synthesis.
+    def advance(self, start, end):
+        if not self.bits and not self.remaining:
+            self.counter = (self.counter - (end - start)) % self.rate
+            return
+
+        cycle = start + self.counter
+        while cycle < end:
+            if not self.bits:
+                if not self.remaining:
+                    break
+                self.shift = self.cpu.dmaRAMRead(self.address)
+                self.address = ((self.address + 1) & 0xFFFF) | 0x8000
+                self.bits = 8
+                self.remaining -= 1
+                if not self.remaining:
+                    if self.loop:
+                        self.restart()
+                    elif self.irqEnabled:
+                        self.irqFlag = True
+                        self.cpu.irq |= 4
+
+            if self.shift & 1:
+                if self.output <= 125:
+                    self.output += 2
+            elif self.output >= 2:
+                self.output -= 2
+            self.changes.append((cycle, self.output))
+            self.shift >>= 1
+            self.bits -= 1
+            cycle += self.rate
+        self.counter = max(cycle - end, 0) % self.rate
+
+    def render(self, times, initial):
+        if not self.changes:
+            return np.full(len(times), initial, dtype=np.intp)
+        cycles, levels = zip(*self.changes)
+        levels = np.array((initial,) + levels)
+        return levels[np.searchsorted(np.array(cycles), times, side='right')]
+
+# The APU is caught up to the current CPU cycle before each register write or status read, which
+# only records the channel settings of the span just ended. Samples for the whole frame are then
+# synthesized at once with numpy in endFrame() instead of stepping the channels every cycle.
+class apu:
+    cpuClock = 1789773
+    frameCycles = 262 * 113
+    # Frame sequencer step lengths and whether each step also clocks lengths and sweeps
+    sequencerSteps = {4: [(7457, False), (7456, True), (7458, False), (7458, True)],
+                      5: [(7457, False), (7456, True), (7458, False), (14910, True)]}
+
+    def __init__(self, cpu, sampleRate=44100, frameRate=60.0988):
+        self.cpu = cpu
+        self.sampleRate = sampleRate
+        self.frameRate = frameRate
+        # Output sample rate is sampleRate * rateScale, audio sinks nudge it to stay in sync
+        self.rateScale = 1.0
+        self.sink = None
+        self.synthesisTime = 0.0
+
+        self.pulse1 = pulseChannel(1)
+        self.pulse2 = pulseChannel(0)
+        self.triangle = triangleChannel()
+        self.noise = noiseChannel()
+        self.dmc = dmcChannel(cpu)
+
+        self.sequencerMode = 4
+        self.sequencerStep = 0
+        self.nextStep = 7457
+        self.irqInhibit = False
+        self.frameIRQ = False
+
+        self.position = 0
+        self.spans = []
+        self.dmcStart = 0
+        self.sampleClock = 0.0
+        self.dcLevel = 0.0
+
+        # Nonlinear mixer lookup tables, indexed by pulse1 + pulse2 and by 3 * triangle + 2 * noise + dmc
+        pulse = np.arange(31)
+        self.pulseTable = np.zeros(31, dtype=np.float32)
+        self.pulseTable[1:] = 95.52 / (8128.0 / pulse[1:] + 100)
+        tnd = np.arange(203)
+        self.tndTable = np.zeros(203, dtype=np.float32)
+        self.tndTable[1:] = 163.67 / (24329.0 / tnd[1:] + 100)
+
+    # CPU cycles since the last endFrame, which runs at the end of scanline 241
+    def cycle(self):
+        return min(((self.cpu.scanline - 242) % 262) * 113 + self.cpu.cyclesClock, self.frameCycles)
+
+    # Record the channel settings up to cycle, clocking the frame sequencer on the way
+    def catchUp(self, cycle):
+        while self.position < cycle:
+            end = min(cycle, self.nextStep)
+            self.spans.append((end - self.position, self.pulse1.state(), self.pulse2.state(),
+                               self.triangle.state(), self.noise.state()))
+            self.dmc.advance(self.position, end)
+            self.position = end
+            if end == self.nextStep:
+                self.clockSequencer()
+
+    def clockSequencer(self):
+        length, half = self.sequencerSteps[self.sequencerMode][self.sequencerStep]
+        for channel in (self.pulse1, self.pulse2, self.triangle, self.noise):
+            channel.quarterFrame()
+            if half:
+                channel.halfFrame()
+        if self.sequencerStep == 3 and self.sequencerMode == 4 and not self.irqInhibit:
+            self.frameIRQ = True
+            self.cpu.irq |= 2
+        self.sequencerStep = (self.sequencerStep + 1) & 3
+        self.nextStep += self.sequencerSteps[self.sequencerMode][self.sequencerStep][0]
+
+    def writeRegister(self, address, value):
+        self.catchUp(self.cycle())
+        if address < 0x4004:
+            self.pulse1.write(address & 3, value)
+        elif address < 0x4008:
+            self.pulse2.write(address & 3, value)
+        elif address < 0x400C:
+            self.triangle.write(address & 3, value)
+        elif address < 0x4010:
+            self.noise.write(address & 3, value)
+        elif address < 0x4014:
+            self.dmc.write(address & 3, value)
+        elif address == 0x4015:
+            for bit, channel in enumerate((self.pulse1, self.pulse2, self.triangle, self.noise)):
+                channel.enabled = bool(value & (1 << bit))
+                if not channel.enabled:
+                    channel.length = 0
+            if not value & 0x10:
+                self.dmc.remaining = 0
+            elif not self.dmc.remaining:
+                self.dmc.restart()
+            self.dmc.irqFlag = False
+            self.cpu.irq &= ~4
+        elif address == 0x4017:
+            self.sequencerMode = 5 if value & 0x80 else 4
+            self.irqInhibit = bool(value & 0x40)
+            if self.irqInhibit:
+                self.frameIRQ = False
+                self.cpu.irq &= ~2
+            self.sequencerStep = 0
+            self.nextStep = self.position + self.sequencerSteps[self.sequencerMode][0][0]
+            # The 5-step mode clocks everything right away
+            if self.sequencerMode == 5:
+                for channel in (self.pulse1, self.pulse2, self.triangle, self.noise):
+                    channel.quarterFrame()
+                    channel.halfFrame()
+
+    def readStatus(self):
+        self.catchUp(self.cycle())
+        value = 0
+        for bit, channel in enumerate((self.pulse1, self.pulse2, self.triangle, self.noise)):
+            if channel.length:
+                value |= 1 << bit
+        if self.dmc.remaining:
+            value |= 0x10
+        if self.frameIRQ:
+            value |= 0x40
+        if self.dmc.irqFlag:
+            value |= 0x80
+        self.frameIRQ = False
+        self.cpu.irq &= ~2
+        return value
 
-                colorIndexFinal += colorIndex
-                if (colorIndexFinal % 4) == 0:
-                    colorIndexFinal = 0x3F00
-                color = self.colorPallete[(self.dmaVRAMRead(colorIndexFinal) & 0x3F)]
+    def endFrame(self):
+        self.catchUp(self.frameCycles)
+        synthesisStart = time.perf_counter()
+        self.sampleClock += self.sampleRate * self.rateScale / self.frameRate
+        count = int(self.sampleClock)
+        self.sampleClock -= count
+        if self.sink is not None:
+            self.sink.push(self.synthesize(count))
+            self.rateScale = self.sink.rateScale
+
+        self.spans = []
+        self.dmc.changes = []
+        self.dmcStart = self.dmc.output
+        self.position = 0
+        self.nextStep -= self.frameCycles
+        self.synthesisTime += time.perf_counter() - synthesisStart
+
+    # Mono float32 samples for the frame, every span is expanded to its share of the samples
+    def synthesize(self, count):
+        cycles = np.array([span[0] for span in self.spans])
+        ends = np.rint(np.cumsum(cycles) * (count / self.frameCycles)).astype(np.intp)
+        counts = np.diff(ends, prepend=0)
+        # Waveform steps per sample use the nominal rate so rate control does not change the pitch
+        cyclesPerSample = self.cpuClock / self.sampleRate
+
+        def expand(values):
+            return np.repeat(np.array(values), counts)
+
+        pulse1 = [span[1] for span in self.spans]
+        pulse2 = [span[2] for span in self.spans]
+        noise = [span[4] for span in self.spans]
+        square1 = self.pulse1.render(expand([state[0] for state in pulse1]) * cyclesPerSample,
+                                     expand([state[1] for state in pulse1]), expand([state[2] for state in pulse1]))
+        square2 = self.pulse2.render(expand([state[0] for state in pulse2]) * cyclesPerSample,
+                                     expand([state[1] for state in pulse2]), expand([state[2] for state in pulse2]))
+        triangle = self.triangle.render(expand([span[3] for span in self.spans]) * cyclesPerSample)
+        noiseOut = self.noise.render(expand([state[0] for state in noise]) * cyclesPerSample,
+                                     expand([state[1] for state in noise]), expand([state[2] for state in noise]))
+        dmc = self.dmc.render(np.arange(count) * (self.frameCycles / max(count, 1)), self.dmcStart)
+
+        samples = self.pulseTable[square1 + square2] + self.tndTable[3 * triangle + 2 * noiseOut + dmc]
+        # Remove the DC offset slowly so the output is centered on 0
+        if count:
+            self.dcLevel += (float(samples.mean()) - self.dcLevel) * 0.05
+        return samples - np.float32(self.dcLevel)
 
-                # Add Transparency
-                if color == self.colorPallete[self.dmaVRAMRead(0x3F10)]:
-                    color += (0,)
+#==================================================================================
+# MAPPER
+#==================================================================================
 
-                pygame.Surface.set_at(self.layerA, (spriteX + j, spriteY + Y), color)
+# 8 KB of PRG-RAM at $6000-$7FFF. For battery carts it is an mmap of the .sav file, so a store
+# only touches memory and flush() syncs just the pages written since the last flush.
+class workRAM:
+    def __init__(self, savePath=None, size=0x2000):
+        self.savePath = savePath
+        self.dirtyPages = set()
+        self.file = None
+        if savePath is None:
+            self.data = bytearray(size)
+            return
+
+        self.file = open(savePath, 'r+b' if os.path.exists(savePath) else 'w+b')
+        if os.fstat(self.file.fileno()).st_size < size:
+            self.file.truncate(size)
+        self.data = mmap.mmap(self.file.fileno(), size)
+        atexit.register(self.close)
+
+    def flush(self):
+        if self.file is None or not self.dirtyPages:
+            return
+        for page in self.dirtyPages:
+            self.data.flush(page * mmap.PAGESIZE, min(mmap.PAGESIZE, len(self.data) - page * mmap.PAGESIZE))
+        self.dirtyPages.clear()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.flush()
+        self.data.close()
+        self.file.close()
+        self.file = None
+
+# A mapper owns the cartridge bank windows. PRG-ROM is split into 8 KB banks once at load, switching
+# a bank repoints an entry of the CPU PRG page table or of the PPU CHR page table without copying it.
+class mapper:
+    def __init__(self, cpu, cartridge):
+        self.cpu = cpu
+        self.ppu = cpu.ppu
+        self.cart = cartridge
+        prg = cartridge.prgRomData
+        self.prgBanks = [prg[i:i + 0x2000] for i in range(0, len(prg), 0x2000)]
+        self.reset()
 
-                if self.showBackground and not(self.spriteHitOccured) and currentSprite == 0 and pygame.Surface.get_at(self.layerA, (spriteX + j, spriteY + Y)) == color:
-                    self.sprite0Hit = True
-                    self.spriteHitOccured = True
+    # NROM layout, a 16 KB PRG-ROM is mirrored at $C000
+    def reset(self):
+        self.setPrg32(0)
+        self.setChr8(0)
 
-    def enterVBlank(self):
-        if self.NMI:
-            self.cpu.doNMI()
+    # Registers sit over the ROM at $8000-$FFFF
+    def writeRegister(self, address, value):
+        pass
 
-        self.VBlank = True
-        self.screen.blit(self.layerB, (0,0))
-        self.screen.blit(self.layerA, (0,0))
-        self.screen.blit(self.debugLayer, (0,0))
-        pygame.display.flip()
+    # Called at the end of each rendered scanline and the pre-render line
+    def clockScanline(self):
+        pass
 
-    def exitVBlank(self):
-        self.VBlank = False
-        self.debugLayer.fill((0,0,0,0))
-        self.layerA.fill((0,0,0,0))
-        self.layerB.fill((0,0,0))
-        pygame.display.flip()
+    def setPrg8(self, slot, bank):
+        self.cpu.prgPages[4 + slot] = self.prgBanks[bank % len(self.prgBanks)]
 
-    def debugMsg(self, msg):
-        self.debugLayer.fill((0,0,0,0))
-        font = pygame.font.Font(pygame.font.get_default_font(), 8)
-        self.debugLayer.blit(font.render(msg, False, (255, 255, 255, 1), (0,0,0,0)),(220,220))
+    # Negative banks count from the end of PRG-ROM
+    def setPrg16(self, slot, bank):
+        if bank < 0:
+            bank += len(self.prgBanks) // 2
+        self.setPrg8(slot * 2, bank * 2)
+        self.setPrg8(slot * 2 + 1, bank * 2 + 1)
+
+    def setPrg32(self, bank):
+        for slot in range(4):
+            self.setPrg8(slot, bank * 4 + slot)
+
+    def setChr1(self, slot, bank):
+        self.ppu.setChrBank(slot, bank)
+
+    def setChr4(self, slot, bank):
+        for i in range(4):
+            self.ppu.setChrBank(slot * 4 + i, bank * 4 + i)
+
+    def setChr8(self, bank):
+        for slot in range(8):
+            self.ppu.setChrBank(slot, bank * 8 + slot)
+
+    def setMirroring(self, mirroring):
+        if mirroring != self.ppu.ppuMirroring:
+            self.ppu.setMirroring(mirroring)
+
+class nrom(mapper):
+    pass
+
+# Mapper 1, registers are loaded one bit per write through a 5-bit shift register
+class mmc1(mapper):
+    def reset(self):
+        self.shift = 0x10
+        self.control = 0x0C
+        self.chrBank0 = 0
+        self.chrBank1 = 0
+        self.prgBank = 0
+        self.updateBanks()
+
+    def writeRegister(self, address, value):
+        if value & 0x80:
+            self.shift = 0x10
+            self.control |= 0x0C
+            self.updateBanks()
+            return
+
+        # The initial 1 reaches bit 0 once four bits are in, the fifth write completes the value
+        full = self.shift & 1
+        self.shift = (self.shift >> 1) | ((value & 1) << 4)
+        if not full:
+            return
+
+        register = (address >> 13) & 3
+        if register == 0:
+            self.control = self.shift
+        elif register == 1:
+            self.chrBank0 = self.shift
+        elif register == 2:
+            self.chrBank1 = self.shift
+        else:
+            self.prgBank = self.shift & 0x0F
+        self.shift = 0x10
+        self.updateBanks()
+
+    def updateBanks(self):
+        self.setMirroring([2, 3, 1, 0][self.control & 3])
+
+        # 512 KB boards (SUROM) take the outer PRG bank from CHR bank 0
+        bank = self.prgBank | (self.chrBank0 & 0x10 if len(self.prgBanks) > 32 else 0)
+        prgMode = (self.control >> 2) & 3
+        if prgMode < 2:
+            self.setPrg32(bank >> 1)
+        elif prgMode == 2:
+            self.setPrg16(0, bank & 0x10)
+            self.setPrg16(1, bank)
+        else:
+            self.setPrg16(0, bank)
+            self.setPrg16(1, bank | 0x0F)
+
+        if self.control & 0x10:
+            self.setChr4(0, self.chrBank0)
+            self.setChr4(1, self.chrBank1)
+        else:
+            self.setChr8(self.chrBank0 >> 1)
+
+# Mapper 2, switchable 16 KB at $8000 and the last bank fixed at $C000
+class uxrom(mapper):
+    def reset(self):
+        self.setPrg16(0, 0)
+        self.setPrg16(1, -1)
+        self.setChr8(0)
+
+    def writeRegister(self, address, value):
+        self.setPrg16(0, value)
+
+# Mapper 3, switchable 8 KB CHR
+class cnrom(mapper):
+    def writeRegister(self, address, value):
+        self.setChr8(value)
+
+# Mapper 7, switchable 32 KB PRG and single screen mirroring
+class axrom(mapper):
+    def reset(self):
+        self.setPrg32(0)
+        self.setChr8(0)
+        self.setMirroring(2)
+
+    def writeRegister(self, address, value):
+        self.setPrg32(value & 0x0F)
+        self.setMirroring(3 if value & 0x10 else 2)
+
+# Mapper 4, 8 KB PRG and 1/2 KB CHR banks plus a scanline counter IRQ.
+# The counter is clocked by PPU A12 rising once per line, so it is clocked from the scanline loop
+# instead of watching pattern fetches. This assumes background at $0000 and sprites at $1000.
+class mmc3(mapper):
+    def reset(self):
+        self.bankSelect = 0
+        self.bankRegisters = [0, 2, 4, 5, 6, 7, 0, 1]
+        self.irqLatch = 0
+        self.irqCounter = 0
+        self.irqReload = False
+        self.irqEnabled = False
+        self.updateBanks()
+
+    def writeRegister(self, address, value):
+        odd = address & 1
+        register = (address >> 13) & 3
+        if register == 0:
+            if odd:
+                self.bankRegisters[self.bankSelect & 7] = value
+            else:
+                self.bankSelect = value
+            self.updateBanks()
+        elif register == 1:
+            if not odd and self.cart.mirror != 4:
+                self.setMirroring(0 if value & 1 else 1)
+        elif register == 2:
+            if odd:
+                self.irqCounter = 0
+                self.irqReload = True
+            else:
+                self.irqLatch = value
+        else:
+            # $E000 disables and acknowledges, $E001 enables
+            self.irqEnabled = bool(odd)
+            if not odd:
+                self.cpu.irq &= ~1
+
+    def updateBanks(self):
+        banks = self.bankRegisters
+        if self.bankSelect & 0x40:
+            self.setPrg8(0, -2)
+            self.setPrg8(2, banks[6])
+        else:
+            self.setPrg8(0, banks[6])
+            self.setPrg8(2, -2)
+        self.setPrg8(1, banks[7])
+        self.setPrg8(3, -1)
+
+        # Two 2 KB banks in one pattern table and four 1 KB banks in the other, swapped by bit 7
+        invert = 4 if self.bankSelect & 0x80 else 0
+        self.setChr1(invert, banks[0] & 0xFE)
+        self.setChr1(invert + 1, banks[0] | 1)
+        self.setChr1(invert + 2, banks[1] & 0xFE)
+        self.setChr1(invert + 3, banks[1] | 1)
+        for i in range(4):
+            self.setChr1((invert ^ 4) + i, banks[2 + i])
+
+    def clockScanline(self):
+        if not (self.ppu.showBackground or self.ppu.showSprites):
+            return
+        if self.irqCounter == 0 or self.irqReload:
+            self.irqCounter = self.irqLatch
+            self.irqReload = False
+        else:
+            self.irqCounter -= 1
+        if self.irqCounter == 0 and self.irqEnabled:
+            self.cpu.irq |= 1
+
+mappers = {0: nrom, 1: mmc1, 2: uxrom, 3: cnrom, 4: mmc3, 7: axrom}
 
 #==================================================================================
 # ADDRESSING MODE
@@ -3841,29 +5128,8 @@ LastWrote___ = 0
 def Strobe():
     global KeysBuffer__, ReadNumber__, LastWrote___
     KeysBuffer__ = 0
-    if ReadNumber__ == 0:
-        if keys[pygame.K_a]:
-            KeysBuffer__ = 1
-    elif ReadNumber__ == 1:
-        if keys[pygame.K_s]:
-            KeysBuffer__ = 1
-    elif ReadNumber__ == 2:
-        if keys[pygame.K_SPACE]:
-            KeysBuffer__ = 1
-    elif ReadNumber__ == 3:
-        if keys[pygame.K_RETURN]:
-            KeysBuffer__ = 1
-    elif ReadNumber__ == 4:
-        if keys[pygame.K_UP]:
-            KeysBuffer__ = 1
-    elif ReadNumber__ == 5:
-        if keys[pygame.K_DOWN]:
-            KeysBuffer__ = 1
-    elif ReadNumber__ == 6:
-        if keys[pygame.K_LEFT]:
-            KeysBuffer__ = 1
-    elif ReadNumber__ == 7:
-        if keys[pygame.K_RIGHT]:
+    if ReadNumber__ < 8:
+        if keys[ReadNumber__]:
             KeysBuffer__ = 1
     elif ReadNumber__ == 16:
         KeysBuffer__ = 1
@@ -3871,16 +5137,868 @@ def Strobe():
     if ReadNumber__ > 23:
         ReadNumber__ = 0
 
+#==================================================================================
+# VIDEO
+#==================================================================================
+
+# Finished frames are handed to the backend as uint8[240, 256, 3] RGB arrays
+class videoBackend:
+    def __init__(self):
+        self.buttons = [0] * 8
+        # Emulator shortcuts pressed since the last frame, e.g. 'turbo'
+        self.hotkeys = []
+
+    def open(self):
+        pass
+
+    def present(self, frame):
+        pass
+
+    def debugMsg(self, msg):
+        pass
+
+    # Debug viewer image, uint8[height, width, 3], shown in its own window where supported
+    def showView(self, name, image):
+        pass
+
+    # Controller state for the next frame, settable through the API on headless backends
+    def pollInput(self):
+        return self.buttons
+
+    def close(self):
+        pass
+
+class nullVideo(videoBackend):
+    pass
+
+class numpyVideo(videoBackend):
+    def __init__(self, keep=1):
+        videoBackend.__init__(self)
+        self.frames = collections.deque(maxlen=keep)
+        self.frameCount = 0
+
+    @property
+    def frame(self):
+        return self.frames[-1] if self.frames else None
+
+    def present(self, frame):
+        self.frames.append(frame.copy())
+        self.frameCount += 1
+
+class imageVideo(videoBackend):
+    # path is a pattern such as frames/%05d.png, the extension selects PNG or PPM
+    def __init__(self, path='frames/%05d.png'):
+        videoBackend.__init__(self)
+        self.path = path
+        self.format = os.path.splitext(path)[1].lower()
+        if self.format not in ('.png', '.ppm'):
+            raise ValueError('Unsupported image format: ' + self.format)
+        try:
+            path % 0
+        except (TypeError, ValueError):
+            raise ValueError('Image path needs one frame number field such as %05d: ' + path)
+        self.frameCount = 0
+
+    def open(self):
+        directory = os.path.dirname(self.path % 0)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def present(self, frame):
+        with open(self.path % self.frameCount, 'wb') as f:
+            if self.format == '.png':
+                f.write(self.encodePNG(frame))
+            else:
+                f.write(b'P6\n%d %d\n255\n' % (frame.shape[1], frame.shape[0]))
+                f.write(frame.tobytes())
+        self.frameCount += 1
+
+    def encodePNG(self, frame):
+        def chunk(kind, data):
+            return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+        height, width = frame.shape[:2]
+        # Every row starts with filter type 0
+        rows = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+        rows[:, 1:] = frame.reshape(height, width * 3)
+        header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+        return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) +
+                chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)) + chunk(b'IEND', b''))
+
+# Composes each frame once on the display surface and flips once, unchanged frames are not presented
+class pygameVideo(videoBackend):
+    def __init__(self, vsync=False):
+        videoBackend.__init__(self)
+        self.vsync = vsync
+        self.frameHash = None
+        self.message = None
+        self.glyphs = {}
+        self.viewWindows = {}
+
+    def open(self):
+        global pygame
+        import pygame
+
+        pygame.init()
+        self.screen = None
+        if self.vsync:
+            # pygame 1 has neither SCALED nor the vsync argument
+            try:
+                self.screen = pygame.display.set_mode((256, 240), pygame.SCALED, vsync=1)
+            except (AttributeError, TypeError, pygame.error):
+                print('vsync not available')
+        if self.screen is None:
+            self.screen = pygame.display.set_mode((256, 240))
+        self.screen.fill((0, 0, 0))
+        pygame.display.flip()
+        self.font = pygame.font.Font(pygame.font.get_default_font(), 8)
+
+        self.keyMap = [pygame.K_a, pygame.K_s, pygame.K_SPACE, pygame.K_RETURN,
+                       pygame.K_UP, pygame.K_DOWN, pygame.K_LEFT, pygame.K_RIGHT]
+
+    def present(self, frame):
+        frameHash = (zlib.crc32(frame), self.message)
+        if frameHash == self.frameHash:
+            return
+        self.frameHash = frameHash
+
+        pygame.surfarray.blit_array(self.screen, frame.swapaxes(0, 1))
+        if self.message:
+            self.drawMessage()
+        pygame.display.flip()
+
+    def debugMsg(self, msg):
+        self.message = msg
+
+    # Each character is rendered once and then blitted from the glyph cache
+    def drawMessage(self):
+        y = 2
+        for line in self.message.split('\n'):
+            x = 2
+            for char in line:
+                glyph = self.glyphs.get(char)
+                if glyph is None:
+                    glyph = self.font.render(char, False, (255, 255, 255), (0, 0, 0))
+                    self.glyphs[char] = glyph
+                self.screen.blit(glyph, (x, y))
+                x += glyph.get_width()
+            y += self.font.get_linesize()
+
+    # The whole queue is drained on every poll, events that are not handled here are dropped
+    def pollInput(self):
+        quit = False
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                quit = True
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_TAB:
+                    self.hotkeys.append('turbo')
+                elif event.key == pygame.K_F1:
+                    self.hotkeys.append('hud')
+                elif event.key == pygame.K_F2:
+                    self.hotkeys.append('palette')
+        pressed = pygame.key.get_pressed()
+        if quit or pressed[pygame.K_ESCAPE] == 1:
+            self.close()
+            sys.exit()
+        self.buttons = [int(pressed[key]) for key in self.keyMap]
+        return self.buttons
+
+    # Extra windows need the SDL2 renderer API of pygame 2, older versions only get the numpy arrays
+    def showView(self, name, image):
+        view = self.viewWindows.get(name)
+        if view is None:
+            try:
+                from pygame._sdl2.video import Window, Renderer
+            except ImportError:
+                print('debug view windows need pygame 2')
+                self.viewWindows[name] = view = False
+            else:
+                window = Window(name, size=(image.shape[1] * 2, image.shape[0] * 2))
+                self.viewWindows[name] = view = Renderer(window)
+        if not view:
+            return
+
+        from pygame._sdl2.video import Texture
+        surface = pygame.surfarray.make_surface(image.swapaxes(0, 1))
+        view.clear()
+        Texture.from_surface(view, surface).draw()
+        view.present()
+
+    # Only the display is shut down here, the mixer belongs to the audio sink
+    def close(self):
+        pygame.display.quit()
+
+# Runs another backend on its own display thread. Frames go through a triple buffer swapped at
+# VBlank, and input is posted back, so the emulation thread never waits on flip or vsync.
+class threadedVideo(videoBackend):
+    def __init__(self, video):
+        videoBackend.__init__(self)
+        self.video = video
+        self.buffers = [np.zeros((240, 256, 3), dtype=np.uint8) for i in range(3)]
+        # Indices of the buffer being filled, the newest complete frame and the one on screen
+        self.back, self.ready, self.front = 0, 1, 2
+        self.fresh = False
+        self.message = None
+        self.views = {}
+        self.condition = threading.Condition()
+        self.opened = threading.Event()
+        self.hotkeyQueue = queue.SimpleQueue()
+        self.stopping = False
+        self.quit = False
+        self.error = None
+        self.thread = None
+
+    def open(self):
+        self.thread = threading.Thread(target=self.displayLoop, name='display', daemon=True)
+        self.thread.start()
+        self.opened.wait()
+        if self.error is not None:
+            self.thread.join()
+            self.thread = None
+            raise self.error
+
+    def present(self, frame):
+        np.copyto(self.buffers[self.back], frame)
+        with self.condition:
+            self.back, self.ready = self.ready, self.back
+            self.fresh = True
+            self.condition.notify()
+
+    def debugMsg(self, msg):
+        self.message = msg
+
+    def showView(self, name, image):
+        with self.condition:
+            self.views[name] = image.copy()
+
+    def pollInput(self):
+        if self.quit:
+            self.close()
+            sys.exit()
+        while not self.hotkeyQueue.empty():
+            self.hotkeys.append(self.hotkeyQueue.get())
+        return self.buttons
+
+    def close(self):
+        if self.thread is None:
+            return
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def displayLoop(self):
+        try:
+            self.video.open()
+        except BaseException as error:
+            self.error = error
+            self.quit = True
+            return
+        finally:
+            self.opened.set()
+
+        try:
+            while not self.stopping:
+                frame = None
+                with self.condition:
+                    # Wake up regularly so window events are handled even while emulation is slow
+                    self.condition.wait_for(lambda: self.fresh or self.stopping, timeout=1 / 120)
+                    if self.fresh:
+                        self.ready, self.front = self.front, self.ready
+                        self.fresh = False
+                        frame = self.buffers[self.front]
+                    views, self.views = self.views, {}
+
+                if frame is not None:
+                    self.video.debugMsg(self.message)
+                    self.video.present(frame)
+                for name, image in views.items():
+                    self.video.showView(name, image)
+
+                self.buttons = list(self.video.pollInput())
+                for hotkey in self.video.hotkeys:
+                    self.hotkeyQueue.put(hotkey)
+                del self.video.hotkeys[:]
+        except SystemExit:
+            return
+        finally:
+            # Whatever ends the loop, the emulation thread has to stop too
+            self.quit = True
+        self.video.close()
+
+# Writes frames from a worker thread so disk speed never stalls emulation.
+# policy 'block' waits for room in the queue, 'drop' discards frames while it is full.
+class videoRecorder:
+    def __init__(self, path, format='y4m', queueSize=8, policy='block'):
+        if format not in ('raw', 'y4m', 'zlib'):
+            raise ValueError('Unknown recording format: ' + format)
+        if policy not in ('block', 'drop'):
+            raise ValueError('Unknown recording policy: ' + policy)
+
+        self.path = path
+        self.format = format
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=queueSize)
+        self.recordedFrames = 0
+        self.droppedFrames = 0
+        self.error = None
+        self.thread = None
+
+    # The file is opened here so a bad path is reported to the caller
+    def start(self):
+        self.file = open(self.path, 'wb')
+        self.thread = threading.Thread(target=self.worker, name='videoRecorder', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def push(self, frame):
+        if self.error is not None:
+            self.droppedFrames += 1
+            return
+        if self.policy == 'block':
+            self.queue.put(frame)
+            return
+
+        try:
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            self.droppedFrames += 1
+
+    def close(self):
+        if self.thread is None:
+            return
+
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    # After a write error the worker keeps draining the queue, so neither push nor close can block
+    def worker(self):
+        headerWritten = False
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            if self.error is not None:
+                self.droppedFrames += 1
+                continue
+            try:
+                headerWritten = self.writeFrame(self.file, frame, headerWritten)
+            except (OSError, ValueError) as error:
+                self.stop(error)
+        try:
+            self.file.close()
+        except OSError as error:
+            if self.error is None:
+                self.stop(error)
+
+    def stop(self, error):
+        self.error = error
+        print('recording stopped: %s' % error)
+
+    def writeFrame(self, f, frame, headerWritten):
+
+        height, width = frame.shape[:2]
+        if not headerWritten:
+            if self.format == 'y4m':
+                f.write(b'YUV4MPEG2 W%d H%d F60099:1000 Ip A1:1 C444\n' % (width, height))
+            elif self.format == 'zlib':
+                f.write(b'NFL1' + struct.pack('<HH', width, height))
+
+        if self.format == 'raw':
+            f.write(frame.tobytes())
+        elif self.format == 'y4m':
+            f.write(b'FRAME\n')
+            f.write(self.toYUV(frame).tobytes())
+        else:
+            data = zlib.compress(frame.tobytes(), 1)
+            f.write(struct.pack('<I', len(data)))
+            f.write(data)
+        self.recordedFrames += 1
+        return True
+
+    # BT.601 studio range, planar Y, Cb, Cr at full resolution
+    def toYUV(self, frame):
+        rgb = frame.reshape(-1, 3).astype(np.float32)
+        matrix = np.array([[65.481, 128.553, 24.966],
+                           [-37.797, -74.203, 112.0],
+                           [112.0, -93.786, -18.214]], dtype=np.float32) / 255
+        yuv = rgb @ matrix.T + np.array([16, 128, 128], dtype=np.float32)
+        return np.rint(yuv).astype(np.uint8).T
+
+def createVideo(name, path=None, vsync=False, threaded=False):
+    if name == 'null':
+        return nullVideo()
+    elif name == 'numpy':
+        return numpyVideo()
+    elif name == 'image':
+        return imageVideo(path) if path else imageVideo()
+    elif name == 'pygame':
+        if threaded:
+            return threadedVideo(pygameVideo(vsync))
+        return pygameVideo(vsync)
+    raise ValueError('Unknown video backend: ' + name)
+
+#==================================================================================
+# DEBUG VIEWS
+#==================================================================================
+
+# Pattern table, nametable and OAM viewers drawn from the PPU caches instead of raw VRAM.
+# They are refreshed once every interval frames, read them as numpy arrays or show them in windows.
+class debugViews:
+    def __init__(self, ppu, interval=30, show=True):
+        self.ppu = ppu
+        self.interval = max(interval, 1)
+        self.show = show
+        # Palette used for the pattern tables, 0-3 background and 4-7 sprite palettes
+        self.palette = 0
+        self.frameCount = 0
+        self.images = {}
+
+    def nextPalette(self):
+        self.palette = (self.palette + 1) & 7
+        self.refresh()
+
+    def endFrame(self):
+        self.frameCount += 1
+        if self.frameCount % self.interval == 0:
+            self.refresh()
+
+    def refresh(self):
+        self.images = {'Pattern Tables': self.patternTables(self.palette),
+                       'Nametables': self.nameTables(),
+                       'OAM': self.oam()}
+        if self.show:
+            for name, image in self.images.items():
+                self.ppu.video.showView(name, image)
+
+    # Palette index to RGB with the current emphasis, like frameRGB
+    def toRGB(self, colors):
+        ppu = self.ppu
+        palette = ppu.grayscaleLUT if ppu.colorMode else ppu.paletteLUT
+        return palette[ppu.colorIntensity].take(ppu.VRAM[0x3F00:0x3F20][colors] & 0x3F, axis=0)
+
+    # Both 128x128 pattern tables side by side
+    def patternTables(self, palette=0):
+        self.ppu.updateTileCache()
+        tables = self.ppu.tileCache.reshape(2, 16, 16, 8, 8).transpose(1, 3, 0, 2, 4).reshape(128, 256)
+        return self.toRGB(np.where(tables, (palette << 2) | tables, 0))
+
+    # The 2x2 logical nametables as mapped now, with the visible screen outlined
+    def nameTables(self):
+        ppu = self.ppu
+        ppu.updateNameTableCache()
+        tables = ppu.nameTableCache[ppu.nameTableBanks].reshape(2, 2, 240, 256)
+        image = self.toRGB(tables.transpose(0, 2, 1, 3).reshape(480, 512))
+
+        originY = ((ppu.nameTableAddress >> 11) & 1) * 240 + ppu.frameScrollY
+        originX = ((ppu.nameTableAddress >> 10) & 1) * 256 + ppu.ppuScrollX
+        rows = (originY + ppu.screenRows) % 480
+        columns = (originX + ppu.screenColumns) & 0x1FF
+        image[rows[[0, -1]][:, None], columns] = (255, 0, 0)
+        image[rows[:, None], columns[[0, -1]]] = (255, 0, 0)
+        return image
+
+    # All 64 sprites in OAM order, 8 per row, drawn unflipped and flipped as on screen
+    def oam(self):
+        ppu = self.ppu
+        ppu.updateTileCache()
+        height = ppu.spriteSize
+        sprites = ppu.SPRRAM.reshape(64, 4).astype(np.intp)
+        tiles, attributes = sprites[:, 1], sprites[:, 2]
+        if height == 16:
+            top = ((tiles & 1) << 8) | (tiles & 0xFE)
+            pixels = np.concatenate((ppu.tileCache[top], ppu.tileCache[top + 1]), axis=1)
+        else:
+            pixels = ppu.tileCache[(ppu.spritePatternTable >> 4) + tiles]
+        pixels = np.where((attributes & 0x40)[:, None, None] != 0, pixels[:, :, ::-1], pixels)
+        pixels = np.where((attributes & 0x80)[:, None, None] != 0, pixels[:, ::-1], pixels)
+
+        colors = np.where(pixels, 0x10 | ((attributes & 3) << 2)[:, None, None] | pixels, 0)
+        sheet = colors.reshape(8, 8, height, 8).transpose(0, 2, 1, 3).reshape(8 * height, 64)
+        return self.toRGB(sheet)
+
+    # OAM as rows of (y, tile, attributes, x)
+    def oamTable(self):
+        return self.ppu.SPRRAM.reshape(64, 4).copy()
+
+#==================================================================================
+# AUDIO
+#==================================================================================
+
+# Receives one block of mono float32 samples per frame from the APU. rateScale is read back after
+# every push, so a sink can stretch or shrink the next blocks slightly to follow its consumer.
+class audioSink:
+    def __init__(self, sampleRate=44100):
+        self.sampleRate = sampleRate
+        self.rateScale = 1.0
+
+    def open(self):
+        pass
+
+    def push(self, samples):
+        pass
+
+    def close(self):
+        pass
+
+class nullAudio(audioSink):
+    pass
+
+class wavAudio(audioSink):
+    def __init__(self, path='audio.wav', sampleRate=44100):
+        audioSink.__init__(self, sampleRate)
+        self.path = path
+        self.file = None
+
+    def open(self):
+        self.file = wave.open(self.path, 'wb')
+        self.file.setnchannels(1)
+        self.file.setsampwidth(2)
+        self.file.setframerate(self.sampleRate)
+        atexit.register(self.close)
+
+    def push(self, samples):
+        self.file.writeframes(toPCM(samples).tobytes())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def toPCM(samples):
+    return (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16)
+
+# Single producer, single consumer ring of samples. Each side only advances its own counter, and the
+# writer publishes its counter after the copy, so neither side needs a lock.
+class ringBuffer:
+    def __init__(self, capacity):
+        self.data = np.zeros(capacity, dtype=np.float32)
+        self.capacity = capacity
+        self.written = 0
+        self.read = 0
+
+    def fill(self):
+        return self.written - self.read
+
+    # Samples that do not fit are dropped, the producer never waits
+    def write(self, samples):
+        count = min(len(samples), self.capacity - self.fill())
+        start = self.written % self.capacity
+        first = min(count, self.capacity - start)
+        self.data[start:start + first] = samples[:first]
+        self.data[:count - first] = samples[first:count]
+        self.written += count
+        return count
+
+    # Missing samples on underrun are filled with the last one played to avoid a click
+    def readInto(self, out):
+        count = min(len(out), self.fill())
+        start = self.read % self.capacity
+        first = min(count, self.capacity - start)
+        out[:first] = self.data[start:start + first]
+        out[first:count] = self.data[:count - first]
+        if count < len(out):
+            out[count:] = out[count - 1] if count else 0.0
+        self.read += count
+        return count
+
+# Plays through pygame.mixer. A consumer thread queues chunks on a mixer channel, and push() only
+# writes to the ring. The block size is tuned so the fill level stays near target, which absorbs
+# drift between the frame pacer and the audio clock without audible pitch changes.
+class pygameAudio(audioSink):
+    def __init__(self, sampleRate=44100, latency=0.06, chunk=512, maxAdjust=0.005):
+        audioSink.__init__(self, sampleRate)
+        self.chunk = chunk
+        self.latency = latency
+        self.maxAdjust = maxAdjust
+        self.setRate(sampleRate)
+        self.underruns = 0
+        self.stopping = False
+        self.thread = None
+
+    def open(self):
+        global pygame
+        import pygame
+
+        try:
+            try:
+                pygame.mixer.init(frequency=self.sampleRate, size=-16, channels=1, buffer=self.chunk,
+                                  allowedchanges=0)
+            except TypeError:
+                # pygame 1 has no allowedchanges and never changes the rate
+                pygame.mixer.init(frequency=self.sampleRate, size=-16, channels=1, buffer=self.chunk)
+        except pygame.error:
+            print('audio not available')
+            return
+        # The APU reads sampleRate back after open(), so a rate the device insists on is followed
+        frequency, size, self.channels = pygame.mixer.get_init()
+        if frequency != self.sampleRate:
+            self.setRate(frequency)
+        self.channel = pygame.mixer.Channel(0)
+        self.thread = threading.Thread(target=self.consumerLoop, name='audio', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def setRate(self, sampleRate):
+        self.sampleRate = sampleRate
+        self.target = self.latency * sampleRate
+        self.ring = ringBuffer(int(self.target * 4))
+        self.averageFill = self.target
+
+    def push(self, samples):
+        if self.thread is None:
+            return
+        self.ring.write(samples)
+        self.averageFill += (self.ring.fill() - self.averageFill) * 0.1
+        error = (self.averageFill - self.target) / self.target
+        self.rateScale = 1.0 - max(-1.0, min(1.0, error)) * self.maxAdjust
+
+    def consumerLoop(self):
+        chunk = np.zeros(self.chunk, dtype=np.float32)
+        while not self.stopping and pygame.mixer.get_init():
+            try:
+                if self.channel.get_queue() is None:
+                    if self.ring.readInto(chunk) < self.chunk:
+                        self.underruns += 1
+                    pcm = toPCM(chunk)
+                    if self.channels == 2:
+                        pcm = np.repeat(pcm, 2)
+                    sound = pygame.mixer.Sound(buffer=pcm.tobytes())
+                    if self.channel.get_busy():
+                        self.channel.queue(sound)
+                    else:
+                        self.channel.play(sound)
+            except pygame.error:
+                break
+            time.sleep(self.chunk / self.sampleRate / 4)
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.stopping = True
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+        pygame.mixer.quit()
+
+def createAudio(name, path=None):
+    if name == 'null':
+        return nullAudio()
+    elif name == 'wav':
+        return wavAudio(path) if path else wavAudio()
+    elif name == 'pygame':
+        return pygameAudio()
+    raise ValueError('Unknown audio backend: ' + name)
+
+#==================================================================================
+# TIMING
+#==================================================================================
+
+# Paces frames to the NTSC rate on an absolute schedule, so sleep jitter does not accumulate.
+# Turbo mode skips the wait entirely for batch runs.
+class framePacer:
+    def __init__(self, rate=60.0988, turbo=False):
+        self.period = 1.0 / rate
+        self.turbo = turbo
+        # Sleep until this close to the deadline, then spin for the rest
+        self.spinTime = 0.002
+        # Further behind than this the schedule restarts instead of rushing to catch up
+        self.maxLag = 0.1
+        self.deadline = None
+        self.lastFrame = None
+        self.frameTimes = collections.deque(maxlen=600)
+        self.frameCount = 0
+        self.lateFrames = 0
+        self.waitTime = 0.0
+
+    def setTurbo(self, turbo):
+        self.turbo = turbo
+        self.deadline = None
+
+    def wait(self):
+        now = waitStart = time.perf_counter()
+        if not self.turbo:
+            if self.deadline is None:
+                self.deadline = now
+            self.deadline += self.period
+
+            remaining = self.deadline - now
+            if remaining > self.spinTime:
+                time.sleep(remaining - self.spinTime)
+            if remaining > 0:
+                while time.perf_counter() < self.deadline:
+                    pass
+            else:
+                self.lateFrames += 1
+                if remaining < -self.maxLag:
+                    self.deadline = now
+            now = time.perf_counter()
+        self.waitTime = now - waitStart
+
+        if self.lastFrame is not None:
+            self.frameTimes.append(now - self.lastFrame)
+        self.lastFrame = now
+        self.frameCount += 1
+
+    def fps(self):
+        if not self.frameTimes:
+            return 0.0
+        return len(self.frameTimes) / sum(self.frameTimes)
+
+    # Frame time statistics in milliseconds over the last frames
+    def stats(self):
+        if not self.frameTimes:
+            return {}
+        times = np.array(self.frameTimes) * 1000
+        return {'frames': self.frameCount,
+                'fps': self.fps(),
+                'mean': float(times.mean()),
+                'min': float(times.min()),
+                'max': float(times.max()),
+                'p99': float(np.percentile(times, 99)),
+                'late': self.lateFrames}
+
+# Live performance counters shown through debugMsg. While hidden the run loop does no timing at all.
+class perfHUD:
+    def __init__(self, visible=False, interval=0.5):
+        self.visible = visible
+        self.interval = interval
+        self.text = ''
+        self.reset()
+
+    def reset(self):
+        self.start = time.perf_counter()
+        self.frames = 0
+        self.instructions = 0
+        self.scanlineTime = 0.0
+        self.presentTime = 0.0
+        self.waitTime = 0.0
+        self.apuTime = 0.0
+
+    def toggle(self):
+        self.visible = not self.visible
+        self.reset()
+
+    # Called once per frame after the pacer, refreshes the text every interval seconds
+    def endFrame(self, instructions, pacer, ppu, apu):
+        self.frames += 1
+        self.instructions += instructions
+        self.presentTime += ppu.presentTime
+        self.waitTime += pacer.waitTime
+        self.apuTime += apu.synthesisTime
+        ppu.presentTime = 0.0
+        apu.synthesisTime = 0.0
+
+        elapsed = time.perf_counter() - self.start
+        if elapsed < self.interval:
+            return
+
+        perFrame = 1000.0 / self.frames
+        presentation = self.presentTime * perFrame
+        emulation = self.scanlineTime - self.presentTime - self.waitTime - self.apuTime
+        ppuTime = emulation * perFrame
+        cpuTime = (elapsed - self.scanlineTime) * perFrame
+        self.text = ('FPS {0:.1f} {1:.1f}ms\nIPS {2:.2f}M\nCPU {3:.1f} PPU {4:.1f} APU {5:.1f} OUT {6:.1f}'
+                     .format(self.frames / elapsed, (elapsed - self.waitTime) * perFrame,
+                             self.instructions / elapsed / 1e6, cpuTime, ppuTime,
+                             self.apuTime * perFrame, presentation))
+        self.reset()
+
 #==================================================================================
 # EXEC EMULATOR
 #==================================================================================
 
 class Exec:
     def __init__(self):
-        romPath = sys.argv[1]
-        self.cartridge = romLoader(romPath)
-        self.cartridge.load()
-        CPU = cpu(self.cartridge)
-        CPU.run()
-
-Exec()
\ No newline at end of file
+        parser = argparse.ArgumentParser()
+        parser.add_argument('rom', nargs='?')
+        parser.add_argument('--render-every', type=int, default=1, help='draw one frame out of N')
+        parser.add_argument('--video', choices=['pygame', 'null', 'numpy', 'image'], default='pygame')
+        parser.add_argument('--video-path', help='image file pattern, e.g. frames/%%05d.png or frames/%%05d.ppm')
+        parser.add_argument('--audio', choices=['pygame', 'null', 'wav'],
+                            help='audio output (default: pygame with the pygame video backend, null otherwise)')
+        parser.add_argument('--audio-path', help='wav output file')
+        parser.add_argument('--vsync', action='store_true', help='wait for vsync when presenting (pygame)')
+        parser.add_argument('--turbo', action='store_true', help='run unthrottled, also toggled with Tab')
+        parser.add_argument('--inline-display', action='store_true', help='present on the emulation thread')
+        parser.add_argument('--hud', action='store_true', help='show the performance overlay, also toggled with F1')
+        parser.add_argument('--record', help='record the video to this file')
+        parser.add_argument('--record-format', choices=['y4m', 'raw', 'zlib'], default='y4m')
+        parser.add_argument('--record-drop', action='store_true', help='drop frames instead of waiting for the disk')
+        parser.add_argument('--member', help='.nes file to run from a .zip archive (default: the first one)')
+        parser.add_argument('--rom-db', help='CRC32 ROM database used to fix bad headers (default: romdb.bin next to main.py)')
+        parser.add_argument('--debug-views', type=int, metavar='N', default=0,
+                            help='show pattern table, nametable and OAM viewers refreshed every N frames')
+        parser.add_argument('--scan', action='append', metavar='DIR',
+                            help='add DIR to the ROM catalog, only changed files are read again')
+        parser.add_argument('--list', action='store_true', help='list the ROM catalog')
+        parser.add_argument('--list-mapper', type=int, metavar='N', help='list only ROMs using mapper N')
+        parser.add_argument('--list-name', metavar='TEXT', help='list only ROMs whose path contains TEXT')
+        parser.add_argument('--catalog', default=os.path.join(os.path.expanduser('~'), '.cache', 'nes', 'library.db'))
+        args = parser.parse_args()
+
+        if args.scan or args.list or args.list_mapper is not None or args.list_name:
+            self.listLibrary(args)
+            return
+        if args.rom is None:
+            parser.error('the following arguments are required: rom')
+
+        directory = os.path.dirname(os.path.abspath(__file__))
+        database = None
+        databasePath = args.rom_db or os.path.join(directory, 'romdb.bin')
+        if args.rom_db or os.path.exists(databasePath):
+            database = romDatabase(databasePath)
+
+        try:
+            archives = archiveIndex(os.path.join(os.path.expanduser('~'), '.cache', 'nes', 'archives.json'))
+            self.cartridge = romLoader(args.rom, database, args.member, archives)
+            self.cartridge.load()
+        except (ValueError, zipfile.BadZipFile, OSError, EOFError, zlib.error) as error:
+            parser.error('%s: %s' % (args.rom, error))
+        # The video backend is opened while the CPU is built, pygame.error is a RuntimeError
+        try:
+            video = createVideo(args.video, args.video_path, args.vsync, not args.inline_display)
+            CPU = cpu(self.cartridge, video)
+        except (ValueError, OSError, RuntimeError) as error:
+            parser.error('video: %s' % error)
+        CPU.ppu.renderEvery = max(args.render_every, 1)
+        CPU.pacer.setTurbo(args.turbo)
+        CPU.hud.visible = args.hud
+        audio = args.audio or ('pygame' if args.video == 'pygame' else 'null')
+        if audio != 'null':
+            CPU.apu.sink = createAudio(audio, args.audio_path)
+            CPU.apu.sink.open()
+            CPU.apu.sampleRate = CPU.apu.sink.sampleRate
+        if args.record:
+            CPU.ppu.recorder = videoRecorder(args.record, args.record_format,
+                                             policy='drop' if args.record_drop else 'block')
+            try:
+                CPU.ppu.recorder.start()
+            except OSError as error:
+                parser.error('%s: %s' % (args.record, error))
+        if args.debug_views > 0:
+            CPU.ppu.debugViews = debugViews(CPU.ppu, args.debug_views)
+        try:
+            CPU.run()
+        finally:
+            # The audio thread must stop before pygame is shut down at exit
+            if CPU.apu.sink is not None:
+                CPU.apu.sink.close()
+
+    def listLibrary(self, args):
+        library = romLibrary(args.catalog)
+        if args.scan:
+            changed, removed = library.scan(args.scan)
+            print('%d files scanned, %d removed' % (changed, removed))
+        for row in library.list(args.list_mapper, args.list_name):
+            name = row['path'] + (' --member ' + row['member'] if row['member'] else '')
+            print('mapper %3d  PRG %4dK  CHR %4dK  %08X  %s' % (row['mapper'], row['prgRomSize'] // 1024,
+                                                                row['chrRomSize'] // 1024, row['crc'], name))
+        library.close()
+
+if __name__ == '__main__':
+    Exec()
\ No newline at end of file